@@ -5,14 +5,19 @@
 from __future__ import annotations
 
 import asyncio
+import concurrent.futures
+import hashlib
 import json
 import os
+import queue
 import random
 import sqlite3
+import threading
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
 
 import requests
 from zoneinfo import ZoneInfo
@@ -34,20 +39,237 @@ WB_CONTENT_TOKEN = os.getenv("WB_CONTENT_TOKEN", "").strip()    # Optional: prod
 SELLER_WAREHOUSE_ID = os.getenv("SELLER_WAREHOUSE_ID", "").strip()
 SHOP_NAME = os.getenv("SHOP_NAME", "Магазин").strip()
 DB_PATH = (os.getenv("DB_PATH", "/tmp/wb_bot.sqlite").strip() or "/tmp/wb_bot.sqlite")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").strip().upper()  # OFF / NORMAL / FULL / EXTRA
+SEEN_RETENTION_DAYS = int(os.getenv("SEEN_RETENTION_DAYS", "14"))  # /orders/new never returns older orders
+SEEN_PRUNE_SECONDS = int(os.getenv("SEEN_PRUNE_SECONDS", "3600"))
+SEEN_PRUNE_BATCH = int(os.getenv("SEEN_PRUNE_BATCH", "500"))
+STORAGE_GROUP_MAX = int(os.getenv("STORAGE_GROUP_MAX", "256"))  # commands per group commit on the DB thread
 POLL_FBS_SECONDS = int(os.getenv("POLL_FBS_SECONDS", "30"))
+# FBS pipeline: poll -> dedupe -> enrich -> render -> store, joined by bounded queues
+FBS_PIPELINE_BATCHES = int(os.getenv("FBS_PIPELINE_BATCHES", "4"))    # polled batches waiting per stage
+FBS_PIPELINE_ORDERS = int(os.getenv("FBS_PIPELINE_ORDERS", "500"))    # single orders waiting per stage
+FBS_ENRICH_CONCURRENCY = int(os.getenv("FBS_ENRICH_CONCURRENCY", "8"))  # enrichment requests (cards/list chunks, stocks) at once
 DAILY_SUMMARY_HOUR_MSK = int(os.getenv("DAILY_SUMMARY_HOUR_MSK", "23"))
 DAILY_SUMMARY_MINUTE_MSK = int(os.getenv("DAILY_SUMMARY_MINUTE_MSK", "50"))
+# empty/stale seen state (e.g. /tmp wiped by a redeploy): mark current orders seen instead of re-sending them.
+# "digest" also sends one compact summary, "silent" sends nothing, "off" disables bootstrap.
+FBS_BOOTSTRAP_MODE = os.getenv("FBS_BOOTSTRAP_MODE", "digest").strip().lower()
+FBS_BOOTSTRAP_STALE_HOURS = int(os.getenv("FBS_BOOTSTRAP_STALE_HOURS", "24"))
 DISABLE_STARTUP_HELLO = os.getenv("DISABLE_STARTUP_HELLO", "0").strip().lower() in ("1", "true", "yes")
+STATS_LOG_SECONDS = int(os.getenv("STATS_LOG_SECONDS", "300"))  # one JSON stats line to stdout per period, 0 = off
 
 MSK = ZoneInfo("Europe/Moscow")
 
+# ---------- Telegram delivery ----------
+TG_GLOBAL_PER_SECOND = float(os.getenv("TG_GLOBAL_PER_SECOND", "25"))  # Bot API: ~30 msg/s overall
+TG_CHAT_PER_MINUTE = float(os.getenv("TG_CHAT_PER_MINUTE", "20"))      # Bot API: ~20 msg/min per group
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_SEND_MAX_TRIES = int(os.getenv("TG_SEND_MAX_TRIES", "5"))
+TG_OUTBOX_MAX = int(os.getenv("TG_OUTBOX_MAX", "1000"))  # per-chat queue bound (backpressure for producers)
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "20"))            # durable outbox rows handed to the sender at once
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "15"))
+# burst coalescing: order notifications are stored as compact blocks and packed into shared messages
+FBS_COALESCE = os.getenv("FBS_COALESCE", "0").strip().lower() in ("1", "true", "yes")
+FBS_COALESCE_MAX_ORDERS = int(os.getenv("FBS_COALESCE_MAX_ORDERS", "10"))
+FBS_COALESCE_WAIT_SECONDS = float(os.getenv("FBS_COALESCE_WAIT_SECONDS", "20"))  # max time a block waits for company
+OUTBOX_MAX_ROUNDS = int(os.getenv("OUTBOX_MAX_ROUNDS", "20"))   # sender rounds (each up to TG_SEND_MAX_TRIES) before a row fails
+# extra order destinations: "chat:cond,cond;chat:cond" where cond is wh=ID|ID, article=VC|PREFIX*, sum>=RUB.
+# Conditions in a route must all match; a route without conditions gets every order.
+# e.g. "-100111:wh=507|1200;-100222:article=SHOE*;@owner:sum>=10000"
+TG_ROUTES = os.getenv("TG_ROUTES", "").strip()
+TG_ROUTE_DEFAULT = os.getenv("TG_ROUTE_DEFAULT", "always").strip().lower()  # TG_CHAT_ID gets: always / unmatched
+
 # ---------- small in-memory caches ----------
-_STOCK_CACHE: Dict[Tuple[int, int], Tuple[float, int]] = {}  # (warehouse_id, chrt_id) -> (expires_ts, amount)
-_CONTENT_SIZES_CACHE: Dict[int, Tuple[float, List[Dict[str, Any]]]] = {}  # nmId -> (expires_ts, sizes)
-_PRODUCT_NAME_CACHE: Dict[int, Tuple[float, str]] = {}
-_CONTENT_CARD_CACHE: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+STOCK_CACHE_MAX_ENTRIES = int(os.getenv("STOCK_CACHE_MAX_ENTRIES", "20000"))
+CONTENT_CACHE_MAX_ENTRIES = int(os.getenv("CONTENT_CACHE_MAX_ENTRIES", "5000"))
+CONTENT_CACHE_MAX_BYTES = int(os.getenv("CONTENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # approx. serialized card size
+BARCODE_INDEX_MAX_ENTRIES = int(os.getenv("BARCODE_INDEX_MAX_ENTRIES", "200000"))
+NEGATIVE_CACHE_TTL_SECONDS = int(os.getenv("NEGATIVE_CACHE_TTL_SECONDS", "600"))  # missing cards/stocks/chrtIds
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv("NEGATIVE_CACHE_MAX_ENTRIES", "20000"))
+CACHE_SWEEP_SECONDS = int(os.getenv("CACHE_SWEEP_SECONDS", "60"))
+# serve-stale: expired entries within the grace window are returned at once and refreshed in the background
+CACHE_SERVE_STALE = os.getenv("CACHE_SERVE_STALE", "1").strip().lower() in ("1", "true", "yes")
+STOCK_STALE_GRACE_SECONDS = int(os.getenv("STOCK_STALE_GRACE_SECONDS", "300"))
+CONTENT_STALE_GRACE_SECONDS = int(os.getenv("CONTENT_STALE_GRACE_SECONDS", "86400"))
+CARD_REFRESH_MIN_SECONDS = int(os.getenv("CARD_REFRESH_MIN_SECONDS", "300"))  # unseen barcode -> refetch card at most this often
 STOCK_CACHE_TTL_SECONDS = int(os.getenv("STOCK_CACHE_TTL_SECONDS", "20"))
+STOCKS_BATCH_SIZE = 1000  # max chrtIds per POST /api/v3/stocks/{warehouseId}
 CONTENT_CACHE_TTL_SECONDS = int(os.getenv("CONTENT_CACHE_TTL_SECONDS", "21600"))  # 6 hours
+CONTENT_BATCH_SIZE = 100  # cards/list cursor limit
+CATALOG_SYNC_SECONDS = int(os.getenv("CATALOG_SYNC_SECONDS", "1800"))  # incremental catalog sync period, 0 = off
+CATALOG_MAX_AGE_SECONDS = int(os.getenv("CATALOG_MAX_AGE_SECONDS", str(7 * 86400)))  # trust local catalog this long without a sync
+
+# ---------- keep-alive HTTP sessions ----------
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))      # urllib3 pools per session
+HTTP_WORKERS = max(1, int(os.getenv("HTTP_WORKERS", "16")))  # WB requests in flight at once (own threads, not the default executor)
+# keep-alive sockets per host; never below HTTP_WORKERS, or urllib3 discards the extra connections ("pool is full")
+HTTP_POOL_MAXSIZE = max(HTTP_WORKERS, int(os.getenv("HTTP_POOL_MAXSIZE", str(HTTP_WORKERS))))
+HTTP_SESSION_IDLE_SECONDS = int(os.getenv("HTTP_SESSION_IDLE_SECONDS", "300"))
+
+# ---------- proactive WB rate limits ----------
+# WB_RATE_LIMITS overrides defaults: "group=requests_per_minute:burst,..." e.g. "content=60:3,stats_orders=1:1"
+WB_RATE_LIMITS = os.getenv("WB_RATE_LIMITS", "").strip()
+
+
+# ---------------- in-memory caches ----------------
+class TTLCache:
+    """Thread-safe TTL + LRU map bounded by entry count and (approximate) bytes.
+
+    Expired entries are dropped on read and by a sweep that runs at most every
+    CACHE_SWEEP_SECONDS on writes; least recently used entries go first when over a bound.
+    With grace > 0, lookup() keeps returning an expired value (flagged stale) until
+    expiry + grace, which is the hard expiry.
+    """
+
+    def __init__(self, name: str, max_entries: int, max_bytes: int = 0, grace: float = 0) -> None:
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self._data: OrderedDict[Any, Tuple[float, Any, int]] = OrderedDict()  # key -> (expires_ts, value, size)
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._next_sweep_ts = time.time() + CACHE_SWEEP_SECONDS
+        self.hits = self.misses = self.stale_hits = self.evictions = self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _drop(self, key: Any) -> None:
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key: Any) -> Any:
+        value, stale = self.lookup(key)
+        return None if stale else value
+
+    def lookup(self, key: Any) -> Tuple[Any, bool]:
+        """(value, stale). value is None on a miss or past hard expiry."""
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None, False
+            expires = item[0]
+            if expires and now >= expires + self.grace:
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None, False
+            self._data.move_to_end(key)
+            if expires and now >= expires:
+                self.stale_hits += 1
+                return item[1], True
+            self.hits += 1
+            return item[1], False
+
+    def put(self, key: Any, value: Any, ttl: float = 0, size: int = 1) -> None:
+        """ttl=0 means no expiry (LRU only)."""
+        now = time.time()
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (now + ttl if ttl else 0.0, value, size)
+            self._bytes += size
+            if now >= self._next_sweep_ts:
+                self.sweep(now)
+            while self._data and (
+                len(self._data) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes)
+            ):
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        now = now or time.time()
+        with self._lock:
+            expired = [k for k, (exp, _, _) in self._data.items() if exp and now >= exp + self.grace]
+            for k in expired:
+                self._drop(k)
+            self.expirations += len(expired)
+            self._next_sweep_ts = now + CACHE_SWEEP_SECONDS
+            return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale_hits": self.stale_hits,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+_STOCK_CACHE = TTLCache(  # (warehouse_id, chrt_id) -> amount
+    "stock", STOCK_CACHE_MAX_ENTRIES, grace=STOCK_STALE_GRACE_SECONDS if CACHE_SERVE_STALE else 0
+)
+_CONTENT_CARD_CACHE = TTLCache(  # nmId -> CardEntry
+    "content", CONTENT_CACHE_MAX_ENTRIES, CONTENT_CACHE_MAX_BYTES, grace=CONTENT_STALE_GRACE_SECONDS if CACHE_SERVE_STALE else 0
+)
+_CONTENT_CACHE_STATS: Dict[str, int] = {"catalog_hits": 0}  # memory hits/misses are counted by _CONTENT_CARD_CACHE
+_BARCODE_INDEX = TTLCache("barcode", BARCODE_INDEX_MAX_ENTRIES)  # barcode -> chrtId, across all cards seen (chrtIds are stable)
+# ("card", nmId) / ("stock", warehouse_id, chrtId) / ("chrt", nmId, barcode) that WB answered with nothing
+_NEGATIVE_CACHE = TTLCache("negative", NEGATIVE_CACHE_MAX_ENTRIES)
+_NEGATIVE_STATS: Dict[str, int] = {"card": 0, "stock": 0, "chrt": 0}
+
+
+def _known_missing(*key: Any) -> bool:
+    return _NEGATIVE_CACHE.get(key) is not None
+
+
+def _remember_missing(*key: Any) -> None:
+    _NEGATIVE_CACHE.put(key, True, NEGATIVE_CACHE_TTL_SECONDS)
+    _NEGATIVE_STATS[key[0]] += 1
+
+
+_REFRESHING: set = set()  # keys with a background refresh running
+_REFRESH_TASKS: set = set()  # strong refs, so running refresh tasks aren't garbage-collected
+_REFRESH_STATS: Dict[str, int] = {"scheduled": 0, "failed": 0}
+
+
+def _refresh_batches(keys: Iterable[Any], size: int) -> List[List[Any]]:
+    """Stale keys without a refresh in flight, in chunks of one batched request each."""
+    todo = [k for k in dict.fromkeys(keys) if k not in _REFRESHING]
+    return [todo[i:i + size] for i in range(0, len(todo), size)]
+
+
+def _schedule_refresh(keys: List[Any], fn: Any, *args: Any) -> None:
+    """Run coroutine fn(*args) as a background task refreshing keys; stale reads of a key that is
+    already being refreshed don't schedule another request (see _refresh_batches)."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _REFRESHING.update(keys)
+    _REFRESH_STATS["scheduled"] += 1
+
+    async def run() -> None:
+        try:
+            await fn(*args)
+        except Exception:
+            _REFRESH_STATS["failed"] += 1
+        finally:
+            _REFRESHING.difference_update(keys)
+
+    task = loop.create_task(run())
+    _REFRESH_TASKS.add(task)
+    task.add_done_callback(_REFRESH_TASKS.discard)
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    out = {c.name: c.stats() for c in (_STOCK_CACHE, _BARCODE_INDEX, _NEGATIVE_CACHE)}
+    out["content"] = content_cache_stats()
+    out["negative"]["stored"] = dict(_NEGATIVE_STATS)
+    out["refresh"] = dict(_REFRESH_STATS, pending=len(_REFRESHING))
+    return out
 
 
 # ---------------- SQLite ----------------
@@ -60,9 +282,28 @@ def _ensure_parent_dir(path: str) -> None:
 def db() -> sqlite3.Connection:
     _ensure_parent_dir(DB_PATH)
     conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+        # switch to incremental auto-vacuum; existing files need one VACUUM to take it
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        conn.execute("VACUUM;")
     conn.execute("PRAGMA journal_mode=WAL;")
+    if DB_SYNCHRONOUS in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS};")
     conn.execute("CREATE TABLE IF NOT EXISTS seen_fbs_orders (order_id TEXT PRIMARY KEY, seen_at TEXT NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS seen_fbs_orders_seen_at ON seen_fbs_orders(seen_at)")
     conn.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v TEXT NOT NULL)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tg_outbox ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT NOT NULL, text TEXT NOT NULL, "
+        "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, next_try_ts REAL NOT NULL DEFAULT 0, "
+        "error TEXT NOT NULL DEFAULT '', kind TEXT NOT NULL DEFAULT 'text', "  # kind: 'text' | 'order_block'
+        "created_at TEXT NOT NULL, updated_at TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS tg_outbox_pending ON tg_outbox(status, next_try_ts)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS catalog ("
+        "nm_id INTEGER PRIMARY KEY, updated_at TEXT NOT NULL, synced_ts REAL NOT NULL, card TEXT NOT NULL)"
+    )
     conn.commit()
     return conn
 
@@ -72,33 +313,424 @@ def kv_get(conn: sqlite3.Connection, k: str, default: str = "") -> str:
     return row[0] if row else default
 
 
-def kv_set(conn: sqlite3.Connection, k: str, v: str) -> None:
-    conn.execute("INSERT OR REPLACE INTO kv(k,v) VALUES(?,?)", (k, v))
-    conn.commit()
+_KV_SET_SQL = "INSERT OR REPLACE INTO kv(k,v) VALUES(?,?)"
+_MARK_SEEN_SQL = "INSERT OR REPLACE INTO seen_fbs_orders(order_id, seen_at) VALUES(?,?)"
 
 
-def seen_order(conn: sqlite3.Connection, order_id: str) -> bool:
-    return conn.execute("SELECT 1 FROM seen_fbs_orders WHERE order_id=? LIMIT 1", (order_id,)).fetchone() is not None
+def seen_orders(conn: sqlite3.Connection, order_ids: List[str]) -> set:
+    """Subset of order_ids already in seen_fbs_orders, one SELECT per 500 ids."""
+    seen: set = set()
+    for i in range(0, len(order_ids), 500):
+        chunk = order_ids[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT order_id FROM seen_fbs_orders WHERE order_id IN ({marks})", chunk).fetchall()
+        seen.update(r[0] for r in rows)
+    return seen
 
 
-def mark_seen(conn: sqlite3.Connection, order_id: str) -> None:
-    conn.execute(
-        "INSERT OR REPLACE INTO seen_fbs_orders(order_id, seen_at) VALUES(?,?)",
-        (order_id, datetime.now(tz=MSK).isoformat()),
+_OUTBOX_INSERT_SQL = "INSERT INTO tg_outbox(chat_id, text, kind, created_at, updated_at) VALUES(?,?,?,?,?)"
+
+
+def outbox_pending(
+    conn: sqlite3.Connection, now_ts: float, limit: int, skip_chats: Iterable[str] = ()
+) -> List[Tuple[int, str, str, int, str]]:
+    skip = list(skip_chats)
+    not_in = f" AND chat_id NOT IN ({','.join('?' * len(skip))})" if skip else ""
+    return conn.execute(
+        "SELECT id, chat_id, text, attempts, kind FROM tg_outbox "
+        f"WHERE status='pending' AND next_try_ts<=?{not_in} ORDER BY id LIMIT ?",
+        (now_ts, *skip, limit),
+    ).fetchall()
+
+
+def prune_outbox_batch(conn: sqlite3.Connection, cutoff_iso: str, limit: int) -> int:
+    cur = conn.execute(
+        "DELETE FROM tg_outbox WHERE rowid IN "
+        "(SELECT rowid FROM tg_outbox WHERE status IN ('sent','failed') AND updated_at < ? LIMIT ?)",
+        (cutoff_iso, limit),
     )
-    conn.commit()
+    return cur.rowcount
+
+
+def latest_seen_at(conn: sqlite3.Connection) -> str:
+    row = conn.execute("SELECT MAX(seen_at) FROM seen_fbs_orders").fetchone()
+    return row[0] if row and row[0] else ""
+
+
+def _seen_rows(conn: sqlite3.Connection) -> List[Tuple[str, str]]:
+    return conn.execute("SELECT order_id, seen_at FROM seen_fbs_orders").fetchall()
+
+
+class SeenOrders:
+    """In-memory mirror of seen_fbs_orders within the retention window.
+
+    Orders stay in /orders/new until confirmed, so the same ids are re-checked every poll;
+    those answer from memory. Only ids missing here are looked up in SQLite.
+    """
+
+    def __init__(self) -> None:
+        self._ids: Dict[str, str] = {}  # order_id -> seen_at
+        self.memory_hits = 0
+        self.db_checks = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    async def load(self, store: Storage) -> int:
+        self._ids = dict(await store.call(_seen_rows))
+        return len(self._ids)
+
+    def add(self, order_id: str, seen_at: str) -> None:
+        self._ids[order_id] = seen_at
+
+    def prune(self, cutoff_iso: str) -> None:
+        self._ids = {k: v for k, v in self._ids.items() if v >= cutoff_iso}
+
+    async def unseen(self, store: Storage, order_ids: List[str]) -> set:
+        misses = [oid for oid in order_ids if oid not in self._ids]
+        self.memory_hits += len(order_ids) - len(misses)
+        if not misses:
+            return set()
+        self.db_checks += len(misses)
+        found = await store.call(seen_orders, misses)
+        now = datetime.now(tz=MSK).isoformat()
+        for oid in found:
+            self._ids.setdefault(oid, now)
+        return set(misses) - found
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._ids),
+            "memory_hits": self.memory_hits,
+            "db_checks": self.db_checks,
+        }
+
+
+_SEEN = SeenOrders()
+
+
+def prune_seen_batch(conn: sqlite3.Connection, cutoff_iso: str, limit: int) -> int:
+    cur = conn.execute(
+        "DELETE FROM seen_fbs_orders WHERE rowid IN (SELECT rowid FROM seen_fbs_orders WHERE seen_at < ? LIMIT ?)",
+        (cutoff_iso, limit),
+    )
+    return cur.rowcount
+
+
+def incremental_vacuum(conn: sqlite3.Connection, pages: int = 1000) -> None:
+    # execute() steps the pragma once and frees a single page; executescript runs it to completion
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+
+
+class Storage:
+    """Single owner of the SQLite connection: a dedicated thread serving a command queue.
+
+    write() takes statements and group-commits everything queued at the time in one
+    transaction (each command in its own savepoint, so one failure doesn't sink the group);
+    call() runs fn(conn, *args) for reads and maintenance outside the group transaction.
+    The event loop only awaits futures and never blocks on SQLite I/O.
+    """
+
+    def __init__(self) -> None:
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-storage", daemon=True)
+        self._ready: concurrent.futures.Future = concurrent.futures.Future()
+        self._closed = False
+        self.commits = 0
+        self.writes = 0
+
+    async def start(self) -> None:
+        self._thread.start()
+        await asyncio.wrap_future(self._ready)
+
+    def stop(self) -> None:
+        self._queue.put(None)
+
+    def submit(self, is_write: bool, fn: Any, args: Tuple[Any, ...]) -> concurrent.futures.Future:
+        fut: concurrent.futures.Future = concurrent.futures.Future()
+        if self._closed:
+            fut.set_exception(RuntimeError("storage is stopped"))
+            return fut
+        self._queue.put((is_write, fn, args, fut))
+        return fut
+
+    async def call(self, fn: Any, *args: Any) -> Any:
+        return await asyncio.wrap_future(self.submit(False, fn, args))
+
+    async def write(self, ops: List[Tuple[str, Tuple[Any, ...]]]) -> None:
+        if ops:
+            await asyncio.wrap_future(self.submit(True, _execute_ops, (ops,)))
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self._queue.qsize(), "writes": self.writes, "commits": self.commits}
+
+    def _commit(self, conn: sqlite3.Connection, pending: List[concurrent.futures.Future]) -> None:
+        try:
+            conn.execute("COMMIT")
+        except Exception as e:
+            self._abort(conn, pending, e)
+            return
+        self.commits += 1
+        for fut in pending:
+            fut.set_result(None)
+
+    @staticmethod
+    def _abort(conn: sqlite3.Connection, futs: List[concurrent.futures.Future], e: Exception) -> None:
+        if conn.in_transaction:
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+        for fut in futs:
+            if not fut.done():
+                fut.set_exception(e)
+
+    def _run(self) -> None:
+        try:
+            conn = db()
+            conn.isolation_level = None  # explicit BEGIN/COMMIT for group commits
+        except Exception as e:
+            self._ready.set_exception(e)
+            return
+        self._ready.set_result(None)
+
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < STORAGE_GROUP_MAX:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            pending: List[concurrent.futures.Future] = []  # writes waiting for the group COMMIT
+            for item in batch:
+                if item is None:
+                    stopping = True
+                    continue
+                is_write, fn, args, fut = item
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if not is_write:
+                        if pending:
+                            self._commit(conn, pending)
+                            pending = []
+                        try:
+                            fut.set_result(fn(conn, *args))
+                        except Exception as e:
+                            fut.set_exception(e)
+                        continue
+                    if not pending:
+                        conn.execute("BEGIN")
+                    conn.execute("SAVEPOINT cmd")
+                    try:
+                        fn(conn, *args)
+                    except Exception as e:
+                        if not conn.in_transaction:
+                            raise  # SQLite already rolled back the whole group
+                        conn.execute("ROLLBACK TO cmd")
+                        conn.execute("RELEASE cmd")
+                        fut.set_exception(e)
+                        if not pending:
+                            conn.execute("COMMIT")  # close the empty transaction
+                        continue
+                    conn.execute("RELEASE cmd")
+                    self.writes += 1
+                    pending.append(fut)
+                except Exception as e:
+                    # SQLite may have rolled the whole transaction back itself (FULL/IOERR/BUSY/NOMEM):
+                    # fail everything the group held and keep serving the queue
+                    self._abort(conn, pending + [fut], e)
+                    pending = []
+            if pending:
+                self._commit(conn, pending)
+
+        self._closed = True
+        conn.close()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item[3].set_running_or_notify_cancel():
+                item[3].set_exception(RuntimeError("storage is stopped"))
+
+
+def _execute_ops(conn: sqlite3.Connection, ops: List[Tuple[str, Tuple[Any, ...]]]) -> None:
+    for sql, params in ops:
+        conn.execute(sql, params)
+
+
+class WriteBatch:
+    """Buffers related writes and commits them in a single transaction on flush()."""
+
+    def __init__(self, store: Storage) -> None:
+        self.store = store
+        self.ops: List[Tuple[str, Tuple[Any, ...]]] = []
+        self.seen: List[Tuple[str, str]] = []  # mirrored into _SEEN once committed
+
+    def add(self, sql: str, params: Tuple[Any, ...]) -> None:
+        self.ops.append((sql, params))
+
+    def mark_seen(self, order_id: str) -> None:
+        seen_at = datetime.now(tz=MSK).isoformat()
+        self.add(_MARK_SEEN_SQL, (order_id, seen_at))
+        self.seen.append((order_id, seen_at))
+
+    def kv_set(self, k: str, v: str) -> None:
+        self.add(_KV_SET_SQL, (k, v))
+
+    def queue_message(self, text: str, chat_id: str = "", kind: str = "text") -> None:
+        """Durable Telegram message, committed together with the rest of the batch."""
+        now = datetime.now(tz=MSK).isoformat()
+        self.add(_OUTBOX_INSERT_SQL, (chat_id or TG_CHAT_ID, text, kind, now, now))
+
+    async def flush(self) -> None:
+        ops, self.ops = self.ops, []
+        seen, self.seen = self.seen, []
+        await self.store.write(ops)
+        for order_id, seen_at in seen:
+            _SEEN.add(order_id, seen_at)
+
+
+# ---------------- HTTP sessions ----------------
+@dataclass
+class PooledSession:
+    session: requests.Session
+    created_ts: float
+    last_used_ts: float
+    requests: int = 0
+    errors: int = 0
+
+
+@dataclass
+class HostStats:
+    sessions_opened: int = 0
+    sessions_evicted: int = 0
+    requests: int = 0
+    errors: int = 0
+
+
+_SESSIONS: Dict[str, PooledSession] = {}  # base URL -> persistent session
+_SESSION_STATS: Dict[str, HostStats] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _base_of(url: str) -> str:
+    parsed = requests.utils.urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+def _new_session() -> requests.Session:
+    s = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def _evict_idle_sessions(now: float) -> None:
+    # caller holds _SESSIONS_LOCK
+    for base, ps in list(_SESSIONS.items()):
+        if now - ps.last_used_ts > HTTP_SESSION_IDLE_SECONDS:
+            _SESSIONS.pop(base, None)
+            _SESSION_STATS.setdefault(base, HostStats()).sessions_evicted += 1
+            try:
+                ps.session.close()
+            except Exception:
+                pass
+
+
+def _http_session(url: str) -> PooledSession:
+    """Keep-alive session for the URL's base (WB marketplace/content/statistics, Telegram)."""
+    base = _base_of(url)
+    now = time.time()
+    with _SESSIONS_LOCK:
+        _evict_idle_sessions(now)
+        ps = _SESSIONS.get(base)
+        if ps is None:
+            ps = PooledSession(session=_new_session(), created_ts=now, last_used_ts=now)
+            _SESSIONS[base] = ps
+            _SESSION_STATS.setdefault(base, HostStats()).sessions_opened += 1
+        ps.last_used_ts = now
+        return ps
+
+
+def http_request(method: str, url: str, **kwargs: Any) -> requests.Response:
+    ps = _http_session(url)
+    stats = _SESSION_STATS.setdefault(_base_of(url), HostStats())
+    ps.requests += 1
+    stats.requests += 1
+    try:
+        return ps.session.request(method, url, **kwargs)
+    except Exception:
+        ps.errors += 1
+        stats.errors += 1
+        raise
+
+
+def http_session_stats() -> Dict[str, Dict[str, Any]]:
+    with _SESSIONS_LOCK:
+        out: Dict[str, Dict[str, Any]] = {}
+        for base, st in _SESSION_STATS.items():
+            ps = _SESSIONS.get(base)
+            out[base] = {
+                "active": ps is not None,
+                "sessions_opened": st.sessions_opened,
+                "sessions_evicted": st.sessions_evicted,
+                "requests": st.requests,
+                "errors": st.errors,
+                "session_requests": ps.requests if ps else 0,
+                "idle_seconds": round(time.time() - ps.last_used_ts, 1) if ps else None,
+            }
+        return out
+
+
+def close_http_sessions() -> None:
+    with _SESSIONS_LOCK:
+        for ps in _SESSIONS.values():
+            try:
+                ps.session.close()
+            except Exception:
+                pass
+        _SESSIONS.clear()
 
 
 # ---------------- Telegram ----------------
-def tg_send(text: str) -> None:
-    if not TG_BOT_TOKEN or not TG_CHAT_ID:
-        return
+@dataclass
+class TgResult:
+    ok: bool
+    retry_after: float = 0.0  # Telegram 429 parameters.retry_after
+    permanent: bool = False  # 4xx other than 429: retrying won't help
+    error: str = ""
+
+
+def _redact_token(text: str) -> str:
+    # requests errors quote the URL, and the URL carries the bot token
+    return text.replace(TG_BOT_TOKEN, "***") if TG_BOT_TOKEN else text
+
+
+def tg_post(chat_id: str, text: str) -> TgResult:
+    """One sendMessage attempt, classified for the outbox retry policy."""
     url = f"{TG_API_BASE}/bot{TG_BOT_TOKEN}/sendMessage"
-    payload = {"chat_id": TG_CHAT_ID, "text": text, "disable_web_page_preview": True}
+    payload = {"chat_id": chat_id, "text": text, "disable_web_page_preview": True}
     try:
-        requests.post(url, json=payload, timeout=(5, 30))
+        resp = http_request("POST", url, json=payload, timeout=(5, 30))
+    except Exception as e:
+        return TgResult(ok=False, error=_redact_token(str(e)))
+    if resp.status_code == 200:
+        return TgResult(ok=True)
+    try:
+        body = resp.json()
     except Exception:
-        pass
+        body = {}
+    params = body.get("parameters") if isinstance(body, dict) else None
+    desc = _redact_token(str((body.get("description") if isinstance(body, dict) else "") or resp.text[:200]))
+    if resp.status_code == 429:
+        retry_after = money_safe((params or {}).get("retry_after")) or 5.0
+        return TgResult(ok=False, retry_after=retry_after, error=desc)
+    return TgResult(ok=False, permanent=400 <= resp.status_code < 500, error=f"{resp.status_code}: {desc}")
 
 
 # ---------------- HTTP helpers ----------------
@@ -107,26 +739,178 @@ class Cooldown:
     until_ts: float = 0.0
 
 
-_HOST_COOLDOWN: Dict[str, Cooldown] = {}
+@dataclass
+class TokenBucket:
+    rate: float  # tokens per second
+    burst: float
+    tokens: float
+    updated_ts: float
+    waits: int = 0
+    waited_seconds: float = 0.0
+
+    def reserve(self, now: float) -> float:
+        """Take one token; returns seconds to wait. Not thread-safe on its own."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_ts) * self.rate)
+        self.updated_ts = now
+        # Reservation: tokens may go negative, so queued callers are served in order.
+        self.tokens -= 1.0
+        if self.tokens >= 0:
+            return 0.0
+        wait = -self.tokens / self.rate
+        self.waits += 1
+        self.waited_seconds += wait
+        return wait
+
+
+# (base URL, path prefix, group, requests per minute, burst) — published WB limits per seller token
+_RATE_RULES: List[Tuple[str, str, str, float, float]] = [
+    (WB_STATISTICS_BASE, "/api/v1/supplier/orders", "stats_orders", 1.0, 1.0),
+    (WB_STATISTICS_BASE, "/api/v1/supplier/sales", "stats_sales", 1.0, 1.0),
+    (WB_STATISTICS_BASE, "/", "statistics", 1.0, 1.0),
+    (WB_CONTENT_BASE, "/", "content", 100.0, 5.0),
+    (WB_MARKETPLACE_BASE, "/", "marketplace", 300.0, 20.0),
+]
+
+_HOST_COOLDOWN: Dict[Tuple[str, str, str], Cooldown] = {}  # limiter key -> cooldown after 429/5xx
+_BUCKETS: Dict[Tuple[str, str, str], TokenBucket] = {}
+_BUCKETS_LOCK = threading.Lock()
+
+
+def _parse_rate_overrides(raw: str) -> Dict[str, Tuple[float, float]]:
+    out: Dict[str, Tuple[float, float]] = {}
+    for part in raw.split(","):
+        group, _, spec = part.partition("=")
+        per_min, _, burst = spec.partition(":")
+        try:
+            out[group.strip()] = (float(per_min), float(burst or 1))
+        except ValueError:
+            continue
+    return out
+
+
+_RATE_OVERRIDES = _parse_rate_overrides(WB_RATE_LIMITS) if WB_RATE_LIMITS else {}
+
+
+def _token_id(headers: Optional[Dict[str, str]]) -> str:
+    token = (headers or {}).get("Authorization", "")
+    return hashlib.blake2b(token.encode(), digest_size=6).hexdigest() if token else "-"
+
+
+def _rate_rule(url: str) -> Tuple[str, Optional[Tuple[float, float]]]:
+    parsed = requests.utils.urlparse(url)
+    base = f"{parsed.scheme}://{parsed.netloc}"
+    for rule_base, prefix, group, per_min, burst in _RATE_RULES:
+        if base == rule_base and parsed.path.startswith(prefix):
+            return group, _RATE_OVERRIDES.get(group, (per_min, burst))
+    return "", None
+
+
+def _limiter_key(url: str, headers: Optional[Dict[str, str]]) -> Tuple[str, str, str]:
+    group, _ = _rate_rule(url)
+    return requests.utils.urlparse(url).netloc, group, _token_id(headers)
+
+
+def _rate_reserve(url: str, headers: Optional[Dict[str, str]]) -> float:
+    """Take one token from the (host, group, token) bucket; returns seconds to wait before sending."""
+    group, limit = _rate_rule(url)
+    if not limit or limit[0] <= 0:
+        return 0.0
+    key = (requests.utils.urlparse(url).netloc, group, _token_id(headers))
+    now = time.monotonic()
+    with _BUCKETS_LOCK:
+        b = _BUCKETS.get(key)
+        if b is None:
+            b = TokenBucket(rate=limit[0] / 60.0, burst=max(1.0, limit[1]), tokens=max(1.0, limit[1]), updated_ts=now)
+            _BUCKETS[key] = b
+        return b.reserve(now)
+
+
+def rate_limiter_stats() -> Dict[str, Dict[str, Any]]:
+    with _BUCKETS_LOCK:
+        return {
+            f"{host}/{group}/{tok}": {
+                "tokens": round(b.tokens, 2),
+                "rate_per_min": round(b.rate * 60, 2),
+                "burst": b.burst,
+                "waits": b.waits,
+                "waited_seconds": round(b.waited_seconds, 1),
+            }
+            for (host, group, tok), b in _BUCKETS.items()
+        }
+
+
+def _jitter(base: float) -> float:
+    return base + random.random() * min(1.5, max(0.2, base * 0.2))
+
 
+async def _async_sleep_with_jitter(base: float) -> None:
+    await asyncio.sleep(_jitter(base))
 
-def _sleep_with_jitter(base: float) -> None:
-    time.sleep(base + random.random() * min(1.5, max(0.2, base * 0.2)))
 
+def _set_cooldown(url: str, headers: Optional[Dict[str, str]], seconds: float) -> None:
+    _HOST_COOLDOWN[_limiter_key(url, headers)] = Cooldown(until_ts=time.time() + seconds)
 
-def _set_cooldown(url: str, seconds: float) -> None:
-    host = requests.utils.urlparse(url).netloc
-    _HOST_COOLDOWN[host] = Cooldown(until_ts=time.time() + seconds)
 
+def _cooldown_left(url: str, headers: Optional[Dict[str, str]]) -> float:
+    cd = _HOST_COOLDOWN.get(_limiter_key(url, headers))
+    return max(0.0, cd.until_ts - time.time()) if cd else 0.0
 
-def _respect_cooldown(url: str) -> None:
-    host = requests.utils.urlparse(url).netloc
-    cd = _HOST_COOLDOWN.get(host)
-    if cd and time.time() < cd.until_ts:
-        _sleep_with_jitter(max(0.0, cd.until_ts - time.time()))
 
+async def _respect_cooldown_async(url: str, headers: Optional[Dict[str, str]]) -> None:
+    left = _cooldown_left(url, headers)
+    if left > 0:
+        await _async_sleep_with_jitter(left)
+    wait = _rate_reserve(url, headers)
+    if wait > 0:
+        await asyncio.sleep(wait)
 
-def http_json(
+
+def _http_attempt(
+    method: str,
+    url: str,
+    headers: Dict[str, str],
+    params: Optional[Dict[str, Any]],
+    json_body: Optional[Dict[str, Any]],
+    timeout: Tuple[float, float],
+    attempt: int,
+) -> Tuple[Optional[float], Any]:
+    """One request. Returns (None, result) when done or (wait_seconds, None) to retry."""
+    resp = http_request(method, url, headers=headers, params=params, json=json_body, timeout=timeout)
+
+    if resp.status_code == 429:
+        retry_after = resp.headers.get("Retry-After")
+        wait = float(retry_after) if retry_after and retry_after.isdigit() else min(120.0, 5.0 * attempt)
+        _set_cooldown(url, headers, wait)
+        return wait, None
+
+    if resp.status_code in (502, 503, 504):
+        wait = min(180.0, 8.0 * attempt)
+        _set_cooldown(url, headers, wait)
+        return wait, None
+
+    if resp.status_code >= 400:
+        return None, {"_http_status": resp.status_code, "_text": resp.text}
+
+    if resp.text.strip().startswith("<"):
+        wait = min(180.0, 8.0 * attempt)
+        _set_cooldown(url, headers, wait)
+        return wait, None
+
+    return None, resp.json()
+
+
+def _error_backoff(e: Exception, attempt: int) -> float:
+    if isinstance(e, (requests.exceptions.SSLError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return min(120.0, 2.0 ** attempt)
+    return min(30.0, 2.0 ** attempt)
+
+
+# WB attempts run here rather than in the default executor, which Telegram sends (30 s read
+# timeout) share: slow Telegram can't starve WB calls and vice versa.
+_HTTP_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=HTTP_WORKERS, thread_name_prefix="wb-http")
+
+
+async def http_json_async(
     method: str,
     url: str,
     headers: Dict[str, str],
@@ -135,44 +919,341 @@ def http_json(
     timeout: Tuple[float, float] = (8, 40),
     max_tries: int = 6,
 ) -> Any:
+    # Cooldowns/backoff are asyncio.sleep (cancellable); a _HTTP_POOL thread is held only
+    # for the duration of a single request.
+    loop = asyncio.get_running_loop()
     last_err: Optional[Exception] = None
     for attempt in range(1, max_tries + 1):
-        _respect_cooldown(url)
+        await _respect_cooldown_async(url, headers)
         try:
-            resp = requests.request(method, url, headers=headers, params=params, json=json_body, timeout=timeout)
+            wait, result = await loop.run_in_executor(
+                _HTTP_POOL, _http_attempt, method, url, headers, params, json_body, timeout, attempt
+            )
+            if wait is None:
+                return result
+            await _async_sleep_with_jitter(wait)
+        except Exception as e:
+            last_err = e
+            await _async_sleep_with_jitter(_error_backoff(e, attempt))
 
-            if resp.status_code == 429:
-                retry_after = resp.headers.get("Retry-After")
-                wait = float(retry_after) if retry_after and retry_after.isdigit() else min(120.0, 5.0 * attempt)
-                _set_cooldown(url, wait)
-                _sleep_with_jitter(wait)
-                continue
+    raise last_err or RuntimeError("http_json failed")
 
-            if resp.status_code in (502, 503, 504):
-                wait = min(180.0, 8.0 * attempt)
-                _set_cooldown(url, wait)
-                _sleep_with_jitter(wait)
-                continue
 
-            if resp.status_code >= 400:
-                return {"_http_status": resp.status_code, "_text": resp.text}
+# ---------------- request coalescing ----------------
+# Concurrent identical requests (same method/url/body/token) share one in-flight call.
+# The leader also parses and caches the response; followers just receive the parsed result.
+# A concurrent.futures.Future is used so worker threads and event-loop tasks can join the same flight.
+_INFLIGHT: Dict[str, concurrent.futures.Future] = {}
+_INFLIGHT_LOCK = threading.Lock()
+_SINGLEFLIGHT_STATS: Dict[str, int] = {"calls": 0, "coalesced": 0}
 
-            if resp.text.strip().startswith("<"):
-                wait = min(180.0, 8.0 * attempt)
-                _set_cooldown(url, wait)
-                _sleep_with_jitter(wait)
-                continue
 
-            return resp.json()
+def _flight_key(method: str, url: str, headers: Dict[str, str], params: Optional[Dict[str, Any]], json_body: Any) -> str:
+    return json.dumps([method, url, _token_id(headers), params, json_body], ensure_ascii=False, sort_keys=True)
 
-        except (requests.exceptions.SSLError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
-            last_err = e
-            _sleep_with_jitter(min(120.0, 2.0 ** attempt))
-        except Exception as e:
-            last_err = e
-            _sleep_with_jitter(min(30.0, 2.0 ** attempt))
 
-    raise last_err or RuntimeError("http_json failed")
+def _flight_join(key: str) -> Tuple[concurrent.futures.Future, bool]:
+    with _INFLIGHT_LOCK:
+        _SINGLEFLIGHT_STATS["calls"] += 1
+        fut = _INFLIGHT.get(key)
+        if fut is not None:
+            _SINGLEFLIGHT_STATS["coalesced"] += 1
+            return fut, False
+        fut = concurrent.futures.Future()
+        _INFLIGHT[key] = fut
+        return fut, True
+
+
+def _flight_finish(key: str, fut: concurrent.futures.Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+    with _INFLIGHT_LOCK:
+        _INFLIGHT.pop(key, None)
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+
+async def singleflight_async(key: str, fn: Any, *args: Any) -> Any:
+    """Async singleflight: the leader awaits fn(*args), followers await its result."""
+    fut, leader = _flight_join(key)
+    if not leader:
+        # shield: a cancelled follower must not cancel the shared flight
+        return await asyncio.shield(asyncio.wrap_future(fut))
+    try:
+        result = await fn(*args)
+    except asyncio.CancelledError:
+        _flight_finish(key, fut, error=RuntimeError("coalesced request cancelled"))
+        raise
+    except Exception as e:
+        _flight_finish(key, fut, error=e)
+        raise
+    _flight_finish(key, fut, result)
+    return result
+
+
+def singleflight_stats() -> Dict[str, int]:
+    with _INFLIGHT_LOCK:
+        return dict(_SINGLEFLIGHT_STATS, inflight=len(_INFLIGHT))
+
+
+# ---------------- Telegram outbox ----------------
+@dataclass
+class OutgoingMessage:
+    chat_id: str
+    text: str
+    enqueued_ts: float
+    done: asyncio.Future
+    attempts: int = 0
+
+
+class TelegramOutbox:
+    """Queued Telegram delivery: one worker per chat, global + per-chat token buckets,
+    429 retry_after honoured, transient failures retried with backoff.
+
+    Producers enqueue() and move on; enqueue only waits when a chat's queue is full.
+    """
+
+    def __init__(self) -> None:
+        now = time.monotonic()
+        self._global = TokenBucket(rate=TG_GLOBAL_PER_SECOND, burst=TG_GLOBAL_PER_SECOND, tokens=TG_GLOBAL_PER_SECOND, updated_ts=now)
+        self._chat_buckets: Dict[str, TokenBucket] = {}
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self.stats: Dict[str, float] = {
+            "sent": 0, "failed": 0, "retries": 0, "rate_limited": 0, "latency_total": 0.0, "latency_max": 0.0,
+        }
+
+    def _queue_for(self, chat_id: str) -> asyncio.Queue:
+        q = self._queues.get(chat_id)
+        if q is None:
+            q = asyncio.Queue(maxsize=TG_OUTBOX_MAX)
+            self._queues[chat_id] = q
+            self._chat_buckets[chat_id] = TokenBucket(
+                rate=TG_CHAT_PER_MINUTE / 60.0, burst=TG_CHAT_BURST, tokens=TG_CHAT_BURST, updated_ts=time.monotonic()
+            )
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id, q))
+        return q
+
+    async def enqueue(self, text: str, chat_id: str = "") -> asyncio.Future:
+        """Queue a message; the returned future resolves to the final TgResult."""
+        done = asyncio.get_running_loop().create_future()
+        chat_id = chat_id or TG_CHAT_ID
+        if not TG_BOT_TOKEN or not chat_id:
+            done.set_result(TgResult(ok=False, permanent=True, error="telegram is not configured"))
+            return done
+        parts = split_message(text)
+        if len(parts) == 1:
+            await self._queue_for(chat_id).put(OutgoingMessage(chat_id, text, time.monotonic(), done))
+            return done
+        # parts share the chat's FIFO queue, so they go out in order; done = all parts delivered
+        q = self._queue_for(chat_id)
+        part_futs = []
+        for part in parts:
+            fut = asyncio.get_running_loop().create_future()
+            part_futs.append(fut)
+            await q.put(OutgoingMessage(chat_id, part, time.monotonic(), fut))
+
+        def _combine(_: Any) -> None:
+            if all(f.done() for f in part_futs) and not done.done():
+                results = [f.result() for f in part_futs]
+                done.set_result(next((r for r in results if not r.ok), results[0]))
+
+        for fut in part_futs:
+            fut.add_done_callback(_combine)
+        return done
+
+    async def try_enqueue(self, text: str, chat_id: str = "") -> Optional[asyncio.Future]:
+        """enqueue() that never waits: None when the chat's queue has no room for the message."""
+        chat_id = chat_id or TG_CHAT_ID
+        if TG_BOT_TOKEN and chat_id:
+            q = self._queue_for(chat_id)
+            if q.maxsize > 0 and q.maxsize - q.qsize() < min(len(split_message(text)), q.maxsize):
+                return None
+        return await self.enqueue(text, chat_id)  # room checked above, so the puts don't wait
+
+    def full_chats(self) -> List[str]:
+        return [chat for chat, q in self._queues.items() if q.full()]
+
+    async def send(self, text: str, chat_id: str = "") -> bool:
+        return (await (await self.enqueue(text, chat_id))).ok
+
+    async def _worker(self, chat_id: str, q: asyncio.Queue) -> None:
+        while True:
+            msg = await q.get()
+            try:
+                res = await self._deliver(msg)
+            except Exception as e:
+                res = TgResult(ok=False, error=str(e))
+            if not msg.done.done():
+                msg.done.set_result(res)
+            q.task_done()
+
+    async def _deliver(self, msg: OutgoingMessage) -> TgResult:
+        while True:
+            now = time.monotonic()
+            wait = max(self._global.reserve(now), self._chat_buckets[msg.chat_id].reserve(now))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            msg.attempts += 1
+            res = await asyncio.to_thread(tg_post, msg.chat_id, msg.text)
+            if res.ok:
+                latency = time.monotonic() - msg.enqueued_ts
+                self.stats["sent"] += 1
+                self.stats["latency_total"] += latency
+                self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+                return res
+            if res.retry_after:
+                # flood control: Telegram says exactly how long to back off; doesn't count as a failed try
+                self.stats["rate_limited"] += 1
+                msg.attempts -= 1
+                await asyncio.sleep(res.retry_after + random.random())
+                continue
+            if res.permanent or msg.attempts >= TG_SEND_MAX_TRIES:
+                self.stats["failed"] += 1
+                return res
+            self.stats["retries"] += 1
+            await _async_sleep_with_jitter(min(60.0, 2.0 ** msg.attempts))
+
+    def outbox_stats(self) -> Dict[str, Any]:
+        sent = self.stats["sent"]
+        return dict(
+            self.stats,
+            latency_avg=round(self.stats["latency_total"] / sent, 3) if sent else 0.0,
+            queued={chat: q.qsize() for chat, q in self._queues.items()},
+        )
+
+
+class DurableOutbox:
+    """Drains tg_outbox rows through a TelegramOutbox and writes their status back in batches.
+
+    Rows are inserted in the same transaction as the seen-mark, so a crash or a failed send
+    leaves them pending and they go out later: at-least-once delivery.
+    'order_block' rows (FBS_COALESCE) are held until FBS_COALESCE_MAX_ORDERS of them are
+    pending for a chat or the oldest has waited FBS_COALESCE_WAIT_SECONDS, then packed into
+    as few messages as fit.
+    """
+
+    def __init__(self, store: Storage, outbox: TelegramOutbox) -> None:
+        self.store = store
+        self.outbox = outbox
+        self.wake = asyncio.Event()
+        self._block_first_seen: Dict[int, float] = {}  # row id -> monotonic ts the sender first saw it
+        self._inflight: Dict[int, int] = {}  # row id -> attempts, handed to the sender and not yet settled
+        self._settled: List[Tuple[str, Tuple[Any, ...]]] = []  # status updates waiting for the next write
+
+    async def run(self) -> None:
+        idle = min(OUTBOX_POLL_SECONDS, FBS_COALESCE_WAIT_SECONDS) if FBS_COALESCE else OUTBOX_POLL_SECONDS
+        while True:
+            try:
+                while True:
+                    await self.flush_settled()
+                    if not await self.drain_once():
+                        break
+            except Exception:
+                pass
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=idle)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+    def _ready_blocks(self, rows: List[Tuple[int, str, str, int, str]]) -> List[Tuple[List[Tuple[int, str, str, int, str]], bool]]:
+        """Per chat: (order blocks, window expired) for chats with something due."""
+        now = time.monotonic()
+        by_chat: Dict[str, List[Tuple[int, str, str, int, str]]] = {}
+        for row in rows:
+            by_chat.setdefault(row[1], []).append(row)
+            self._block_first_seen.setdefault(row[0], now)
+        due = []
+        for chat_rows in by_chat.values():
+            oldest = min(self._block_first_seen[r[0]] for r in chat_rows)
+            expired = now - oldest >= FBS_COALESCE_WAIT_SECONDS
+            if expired or len(chat_rows) >= FBS_COALESCE_MAX_ORDERS:
+                due.append((chat_rows, expired))
+        return due
+
+    async def drain_once(self) -> int:
+        """Hand due rows to the sender without waiting for delivery.
+
+        Each message settles on its own (see _settle), so a slow or rate-limited chat only
+        holds back its own rows, never the status writes or the next drain for other chats.
+        Chats whose sender queue is full are skipped; their rows wait in SQLite.
+        """
+        limit = max(OUTBOX_BATCH, FBS_COALESCE_MAX_ORDERS * 2)
+        full = set(self.outbox.full_chats())
+        rows = await self.store.call(outbox_pending, time.time(), limit + len(self._inflight), full)
+        rows = [r for r in rows if r[0] not in self._inflight][:limit]
+        if not rows:
+            return 0
+
+        # (chat_id, text, row ids the message covers)
+        sends: List[Tuple[str, str, List[Tuple[int, int]]]] = []
+        for row_id, chat_id, text, attempts, kind in rows:
+            if kind != "order_block":
+                sends.append((chat_id, text, [(row_id, attempts)]))
+        for chat_rows, expired in self._ready_blocks([r for r in rows if r[4] == "order_block"]):
+            blocks = [r[2] for r in chat_rows]
+            packs = pack_order_blocks(blocks, FBS_COALESCE_MAX_ORDERS)
+            if not expired and len(packs[-1]) < FBS_COALESCE_MAX_ORDERS:
+                packs.pop()  # partial tail keeps waiting for company until its window closes
+            for pack in packs:
+                sends.append((
+                    chat_rows[0][1],
+                    fmt_order_pack([blocks[i] for i in pack]),
+                    [(chat_rows[i][0], chat_rows[i][3]) for i in pack],
+                ))
+        if not sends:
+            return 0
+        sends.sort(key=lambda s: s[2][0][0])  # keep row-id order per chat
+
+        handed = 0
+        for chat_id, text, covered in sends:
+            if chat_id in full:
+                continue  # keeps the chat's row order: nothing later jumps a skipped message
+            fut = await self.outbox.try_enqueue(text, chat_id)
+            if fut is None:
+                full.add(chat_id)
+                continue
+            for row_id, attempts in covered:
+                self._inflight[row_id] = attempts
+                self._block_first_seen.pop(row_id, None)
+            fut.add_done_callback(lambda f, covered=covered: self._settle(covered, f))
+            handed += len(covered)
+        return handed
+
+    def _settle(self, covered: List[Tuple[int, int]], fut: "asyncio.Future[TgResult]") -> None:
+        res = fut.result() if not fut.cancelled() and fut.exception() is None else TgResult(False, error="cancelled")
+        now_iso = datetime.now(tz=MSK).isoformat()
+        for row_id, attempts in covered:
+            self._settled.append(_outbox_status_op(row_id, attempts, res, now_iso))
+        self.wake.set()
+
+    async def flush_settled(self) -> None:
+        ops, self._settled = self._settled, []
+        if not ops:
+            return
+        try:
+            await self.store.write(ops)
+        except Exception:
+            self._settled[:0] = ops
+            raise
+        for sql, params in ops:
+            self._inflight.pop(params[-1], None)
+
+
+def _outbox_status_op(row_id: int, attempts: int, res: TgResult, now_iso: str) -> Tuple[str, Tuple[Any, ...]]:
+    if res.ok:
+        return "UPDATE tg_outbox SET status='sent', attempts=?, updated_at=? WHERE id=?", (attempts + 1, now_iso, row_id)
+    if res.permanent or attempts + 1 >= OUTBOX_MAX_ROUNDS:
+        return (
+            "UPDATE tg_outbox SET status='failed', attempts=?, error=?, updated_at=? WHERE id=?",
+            (attempts + 1, res.error[:500], now_iso, row_id),
+        )
+    next_try = time.time() + min(3600.0, 30.0 * (attempts + 1))
+    return (
+        "UPDATE tg_outbox SET attempts=?, next_try_ts=?, error=?, updated_at=? WHERE id=?",
+        (attempts + 1, next_try, res.error[:500], now_iso, row_id),
+    )
 
 
 # ---------------- WB headers ----------------
@@ -190,9 +1271,8 @@ def content_headers() -> Dict[str, str]:
 
 
 # ---------------- WB API calls ----------------
-def mp_get_new_fbs_orders() -> List[Dict[str, Any]]:
-    url = f"{WB_MARKETPLACE_BASE}/api/v3/orders/new"
-    data = http_json("GET", url, headers=mp_headers())
+# Each call is split into request/parse parts; the parse part also fills the caches.
+def _fbs_orders_from(data: Any) -> List[Dict[str, Any]]:
     if isinstance(data, dict) and "_http_status" in data:
         raise RuntimeError(f"marketplace http {data.get('_http_status')}: {str(data.get('_text'))[:300]}")
     if isinstance(data, dict):
@@ -202,34 +1282,73 @@ def mp_get_new_fbs_orders() -> List[Dict[str, Any]]:
     return data if isinstance(data, list) else []
 
 
-def seller_stock_amount(warehouse_id: int, chrt_id: int) -> Optional[int]:
-    if not warehouse_id or not chrt_id or not WB_MP_TOKEN:
-        return None
+async def mp_get_new_fbs_orders_async() -> List[Dict[str, Any]]:
+    url = f"{WB_MARKETPLACE_BASE}/api/v3/orders/new"
+    return _fbs_orders_from(await http_json_async("GET", url, headers=mp_headers()))
 
-    cache_key = (warehouse_id, chrt_id)
-    cached = _STOCK_CACHE.get(cache_key)
-    if cached and time.time() < cached[0]:
-        return cached[1]
 
+async def _fetch_stocks_async(warehouse_id: int, chrt_ids: List[int]) -> Dict[int, int]:
     url = f"{WB_MARKETPLACE_BASE}/api/v3/stocks/{warehouse_id}"
-    data = http_json("POST", url, headers=mp_headers(), json_body={"chrtIds": [chrt_id]}, max_tries=4)
+    body = {"chrtIds": chrt_ids}
+
+    async def fetch() -> Dict[int, int]:
+        data = await http_json_async("POST", url, headers=mp_headers(), json_body=body, max_tries=4)
+        return _stocks_from(data, warehouse_id, chrt_ids)
+
+    return await singleflight_async(_flight_key("POST", url, mp_headers(), None, body), fetch)
+
+
+def _stocks_from(data: Any, warehouse_id: int, requested: Iterable[int] = ()) -> Dict[int, int]:
+    """Parse a stocks response into {chrtId: amount} and cache every row.
+
+    Requested chrtIds absent from a successful response are negative-cached.
+    """
+    out: Dict[int, int] = {}
     if isinstance(data, dict) and "_http_status" in data:
-        return None
+        return out
 
     stocks = data.get("stocks") if isinstance(data, dict) else data
     if isinstance(stocks, list):
         for s in stocks:
-            if int_safe(s.get("chrtId") or s.get("chrtID")) == chrt_id:
+            if not isinstance(s, dict):
+                continue
+            cid = int_safe(s.get("chrtId") or s.get("chrtID"))
+            if cid:
                 amount = int_safe(s.get("amount") or s.get("quantity") or 0)
-                _STOCK_CACHE[cache_key] = (time.time() + STOCK_CACHE_TTL_SECONDS, amount)
-                return amount
-    return None
-
-
-def content_get_cards_by_nm(nm_ids: List[int]) -> List[Dict[str, Any]]:
-    """Best-effort Content API call. Used only for names and barcode->chrtId fallback."""
-    if not nm_ids or not (WB_CONTENT_TOKEN or WB_MP_TOKEN):
-        return []
+                _STOCK_CACHE.put((warehouse_id, cid), amount, STOCK_CACHE_TTL_SECONDS)
+                out[cid] = amount
+        for cid in requested:
+            if cid not in out:
+                _remember_missing("stock", warehouse_id, cid)
+    return out
+
+
+async def seller_stock_amounts_async(warehouse_id: int, chrt_ids: Iterable[int]) -> Dict[int, int]:
+    """Stocks for many chrtIds of one warehouse: cache first, then one POST per STOCKS_BATCH_SIZE chunk."""
+    out: Dict[int, int] = {}
+    if not warehouse_id or not WB_MP_TOKEN:
+        return out
+
+    missing: List[int] = []
+    stale: List[Tuple[str, int, int]] = []
+    for cid in dict.fromkeys(c for c in chrt_ids if c):
+        cached, is_stale = _STOCK_CACHE.lookup((warehouse_id, cid))
+        if cached is not None:
+            out[cid] = cached
+            if is_stale:
+                stale.append(("stock", warehouse_id, cid))
+        elif not _known_missing("stock", warehouse_id, cid):
+            missing.append(cid)
+    # stale amounts are served now and refreshed in the background, batched like the misses
+    for keys in _refresh_batches(stale, STOCKS_BATCH_SIZE):
+        _schedule_refresh(keys, _fetch_stocks_async, warehouse_id, [k[2] for k in keys])
+
+    for i in range(0, len(missing), STOCKS_BATCH_SIZE):
+        out.update(await _fetch_stocks_async(warehouse_id, missing[i:i + STOCKS_BATCH_SIZE]))
+    return out
+
+
+def _cards_request(nm_ids: List[int]) -> Tuple[str, Dict[str, Any]]:
     url = f"{WB_CONTENT_BASE}/content/v2/get/cards/list"
     body = {
         "settings": {
@@ -237,117 +1356,276 @@ def content_get_cards_by_nm(nm_ids: List[int]) -> List[Dict[str, Any]]:
             "filter": {"withPhoto": -1, "nmID": nm_ids},
         }
     }
-    data = http_json("POST", url, headers=content_headers(), json_body=body, max_tries=3)
+    return url, body
+
+
+@dataclass
+class CardEntry:
+    """A Content API card plus the fields derived from it once, when it enters the cache."""
+    card: Dict[str, Any]
+    title: str
+    vendor_code: str
+    sizes: List[Dict[str, Any]]
+    barcodes: Dict[str, int]  # barcode -> chrtId
+    fetched_ts: float
+
+
+def _first_text(card: Dict[str, Any], keys: Iterable[str]) -> str:
+    for k in keys:
+        val = str(card.get(k) or "").strip()
+        if val:
+            return val
+    return ""
+
+
+def _barcode_index(sizes: List[Dict[str, Any]]) -> Dict[str, int]:
+    index: Dict[str, int] = {}
+    for s in sizes:
+        if not isinstance(s, dict):
+            continue
+        chrt_id = int_safe(s.get("chrtId") or s.get("chrtID"))
+        if not chrt_id:
+            continue
+        for sku in s.get("skus") or []:
+            if sku is not None:
+                index[str(sku)] = chrt_id
+    return index
+
+
+def _card_entry_of(card: Dict[str, Any], fetched_ts: Optional[float] = None) -> CardEntry:
+    raw_sizes = card.get("sizes")
+    sizes = raw_sizes if isinstance(raw_sizes, list) else []
+    barcodes = _barcode_index(sizes)
+    for barcode, chrt_id in barcodes.items():
+        _BARCODE_INDEX.put(barcode, chrt_id)
+    return CardEntry(
+        card=card,
+        title=_first_text(card, ("title", "imtName", "goodsName", "name", "object", "objectName", "subjectName")),
+        vendor_code=_first_text(card, ("vendorCode", "supplierArticle", "article")),
+        sizes=sizes,
+        barcodes=barcodes,
+        fetched_ts=time.time() if fetched_ts is None else fetched_ts,
+    )
+
+
+def _cards_from(data: Any, requested: Iterable[int] = ()) -> Dict[int, CardEntry]:
+    """Cache the cards of a cards/list response; returns the new entries by nmId."""
     if isinstance(data, dict) and "_http_status" in data:
-        return []
+        return {}
     cards = data.get("cards") if isinstance(data, dict) else []
     if not isinstance(cards, list):
-        return []
+        return {}
 
     # Cache full cards by nmID/nmId. This is important because Marketplace order fields
     # can contain ambiguous/unstable "subject" text; the actual product title/vendorCode
     # should be taken from Content API by nmId whenever possible.
-    expires = time.time() + CONTENT_CACHE_TTL_SECONDS
+    found: Dict[int, CardEntry] = {}
     for card in cards:
         if not isinstance(card, dict):
             continue
         cid = int_safe(card.get("nmID") or card.get("nmId") or card.get("nm_id"))
         if cid:
-            _CONTENT_CARD_CACHE[cid] = (expires, card)
-    return cards
-
+            found[cid] = _card_entry_of(card)
+            _cache_card(cid, found[cid])
+            _NEGATIVE_CACHE.pop(("card", cid))
+    for nm_id in requested:
+        if nm_id not in found:
+            _remember_missing("card", nm_id)
+    return found
 
 
-def content_get_card(nm_id: int) -> Dict[str, Any]:
-    if not nm_id:
+async def content_get_cards_by_nm_async(nm_ids: List[int]) -> Dict[int, CardEntry]:
+    if not nm_ids or not (WB_CONTENT_TOKEN or WB_MP_TOKEN):
         return {}
-    cached = _CONTENT_CARD_CACHE.get(nm_id)
-    if cached and time.time() < cached[0]:
-        return cached[1]
-    cards = content_get_cards_by_nm([nm_id])
-    for card in cards:
-        cid = int_safe(card.get("nmID") or card.get("nmId") or card.get("nm_id"))
-        if cid == nm_id:
-            return card
-    return {}
-
-
-def content_title(nm_id: int) -> str:
-    card = content_get_card(nm_id)
-    if not card:
-        return ""
-    for k in ("title", "imtName", "goodsName", "name", "object", "objectName", "subjectName"):
-        val = str(card.get(k) or "").strip()
-        if val:
-            return val
-    return ""
-
-
-def content_vendor_code(nm_id: int) -> str:
-    card = content_get_card(nm_id)
-    if not card:
-        return ""
-    for k in ("vendorCode", "supplierArticle", "article"):
-        val = str(card.get(k) or "").strip()
-        if val:
-            return val
-    return ""
+    url, body = _cards_request(nm_ids)
+
+    async def fetch() -> Dict[int, CardEntry]:
+        data = await http_json_async("POST", url, headers=content_headers(), json_body=body, max_tries=3)
+        found = _cards_from(data, nm_ids)
+        await catalog_upsert([e.card for e in found.values()])
+        return found
+
+    return await singleflight_async(_flight_key("POST", url, content_headers(), None, body), fetch)
+
+
+def _card_size(card: Dict[str, Any]) -> int:
+    return len(json.dumps(card, ensure_ascii=False))
+
+
+def _cache_card(nm_id: int, entry: CardEntry, size: int = 0) -> None:
+    _CONTENT_CARD_CACHE.put(nm_id, entry, CONTENT_CACHE_TTL_SECONDS, size or _card_size(entry.card))
+
+
+async def _cards_from_catalog(nm_ids: List[int]) -> Dict[int, CardEntry]:
+    """Catalog cards for nm_ids, loaded into the memory cache."""
+    out: Dict[int, CardEntry] = {}
+    for nm_id, (synced_ts, card) in (await catalog_get_many(nm_ids)).items():
+        _CONTENT_CACHE_STATS["catalog_hits"] += 1
+        out[nm_id] = _card_entry_of(card, synced_ts)
+        _cache_card(nm_id, out[nm_id])
+    return out
+
+
+def content_cache_stats() -> Dict[str, int]:
+    return dict(_CONTENT_CARD_CACHE.stats(), **_CONTENT_CACHE_STATS)
+
+
+async def content_cards_async(nm_ids: Iterable[int]) -> Dict[int, CardEntry]:
+    """Cards for many nmIds: memory, then the catalog, then cards/list for the rest in
+    CONTENT_BATCH_SIZE chunks. Best-effort: failed chunks are simply absent."""
+    out: Dict[int, CardEntry] = {}
+    missing: List[int] = []
+    stale: List[Tuple[str, int]] = []
+    for nm_id in dict.fromkeys(n for n in nm_ids if n):
+        entry, is_stale = _CONTENT_CARD_CACHE.lookup(nm_id)
+        if entry is not None:
+            out[nm_id] = entry
+            if is_stale:
+                stale.append(("card", nm_id))
+        elif not _known_missing("card", nm_id):
+            missing.append(nm_id)
+    for keys in _refresh_batches(stale, CONTENT_BATCH_SIZE):
+        _schedule_refresh(keys, content_get_cards_by_nm_async, [k[1] for k in keys])
+    if missing:
+        out.update(await _cards_from_catalog(missing))
+        missing = [n for n in missing if n not in out]
+    out.update(await content_fetch_cards_async(missing))
+    return out
+
+
+async def content_fetch_cards_async(nm_ids: List[int]) -> Dict[int, CardEntry]:
+    """cards/list for nm_ids regardless of what is cached, chunks in parallel."""
+    out: Dict[int, CardEntry] = {}
+    chunks = [nm_ids[i:i + CONTENT_BATCH_SIZE] for i in range(0, len(nm_ids), CONTENT_BATCH_SIZE)]
+    for res in await gather_bounded([content_get_cards_by_nm_async(c) for c in chunks]):
+        if isinstance(res, dict):
+            out.update(res)
+    return out
+
+
+# ---------------- product catalog ----------------
+# Local copy of Content API cards in SQLite, so card data survives restarts.
+# Filled by a cursor-paginated full sync, then kept fresh by incremental syncs from the saved cursor.
+# Reads and writes go through Storage like everything else; the enrichment path reaches it via
+# _CATALOG_STORE (set by catalog_open), and works without a catalog until then.
+_CATALOG_STORE: Optional[Storage] = None
+_CATALOG_LAST_SYNC_TS = 0.0
+_CATALOG_UPSERT_SQL = "INSERT OR REPLACE INTO catalog(nm_id, updated_at, synced_ts, card) VALUES(?,?,?,?)"
+
+
+async def catalog_open(store: Storage) -> None:
+    global _CATALOG_STORE, _CATALOG_LAST_SYNC_TS
+    _CATALOG_LAST_SYNC_TS = money_safe(await store.call(kv_get, "catalog_synced_ts", "0"))
+    _CATALOG_STORE = store
+
+
+def _catalog_rows(conn: sqlite3.Connection, nm_ids: List[int]) -> List[Tuple[int, float, str]]:
+    rows: List[Tuple[int, float, str]] = []
+    for i in range(0, len(nm_ids), 500):
+        chunk = nm_ids[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        rows.extend(conn.execute(f"SELECT nm_id, synced_ts, card FROM catalog WHERE nm_id IN ({marks})", chunk).fetchall())
+    return rows
+
+
+async def catalog_get_many(nm_ids: List[int]) -> Dict[int, Tuple[float, Dict[str, Any]]]:
+    """Trusted catalog cards by nmId, each with the time its row was last synced."""
+    if _CATALOG_STORE is None or not nm_ids:
+        return {}
+    try:
+        rows = await _CATALOG_STORE.call(_catalog_rows, nm_ids)
+    except sqlite3.Error:
+        return {}
+    out: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+    now = time.time()
+    for nm_id, synced_ts, raw in rows:
+        if now - max(synced_ts, _CATALOG_LAST_SYNC_TS) > CATALOG_MAX_AGE_SECONDS:
+            continue
+        try:
+            card = json.loads(raw)
+        except ValueError:
+            continue
+        if isinstance(card, dict):
+            out[nm_id] = (synced_ts, card)
+    return out
 
 
-def content_get_sizes(nm_id: int) -> List[Dict[str, Any]]:
-    if not nm_id:
-        return []
-    cached = _CONTENT_SIZES_CACHE.get(nm_id)
-    if cached and time.time() < cached[0]:
-        return cached[1]
+def _catalog_upsert_ops(cards: List[Dict[str, Any]]) -> List[Tuple[str, Tuple[Any, ...]]]:
+    now = time.time()
+    ops: List[Tuple[str, Tuple[Any, ...]]] = []
+    for card in cards:
+        if not isinstance(card, dict):
+            continue
+        cid = int_safe(card.get("nmID") or card.get("nmId") or card.get("nm_id"))
+        if cid:
+            ops.append((_CATALOG_UPSERT_SQL, (cid, str(card.get("updatedAt") or ""), now, json.dumps(card, ensure_ascii=False))))
+    return ops
 
-    cards = content_get_cards_by_nm([nm_id])
-    sizes: List[Dict[str, Any]] = []
-    name = ""
-    if cards:
-        card = cards[0]
-        name = str(card.get("title") or card.get("subjectName") or card.get("vendorCode") or "").strip()
-        raw_sizes = card.get("sizes")
-        if isinstance(raw_sizes, list):
-            sizes = raw_sizes
 
-    if name:
-        _PRODUCT_NAME_CACHE[nm_id] = (time.time() + CONTENT_CACHE_TTL_SECONDS, name)
-    _CONTENT_SIZES_CACHE[nm_id] = (time.time() + CONTENT_CACHE_TTL_SECONDS, sizes)
-    return sizes
+async def catalog_upsert(cards: List[Dict[str, Any]]) -> int:
+    ops = _catalog_upsert_ops(cards)
+    if _CATALOG_STORE is None or not ops:
+        return 0
+    try:
+        await _CATALOG_STORE.write(ops)
+    except sqlite3.Error:
+        return 0
+    return len(ops)
 
 
-def product_name_from_content(nm_id: int) -> str:
-    if not nm_id:
-        return ""
-    cached = _PRODUCT_NAME_CACHE.get(nm_id)
-    if cached and time.time() < cached[0]:
-        return cached[1]
-    content_get_sizes(nm_id)
-    cached = _PRODUCT_NAME_CACHE.get(nm_id)
-    return cached[1] if cached else ""
+async def catalog_sync(store: Storage) -> int:
+    """Page through cards/list sorted by updatedAt from the saved cursor; an empty cursor means a full sync."""
+    global _CATALOG_LAST_SYNC_TS
+    url = f"{WB_CONTENT_BASE}/content/v2/get/cards/list"
+    try:
+        cursor = json.loads(await store.call(kv_get, "catalog_cursor", "") or "{}")
+    except ValueError:
+        cursor = {}
+    cursor = cursor if isinstance(cursor, dict) else {}
+    total = 0
+    while True:
+        page_cursor: Dict[str, Any] = {"limit": CONTENT_BATCH_SIZE}
+        if cursor.get("updatedAt") and cursor.get("nmID"):
+            page_cursor.update(updatedAt=cursor["updatedAt"], nmID=cursor["nmID"])
+        body = {"settings": {"sort": {"ascending": True}, "cursor": page_cursor, "filter": {"withPhoto": -1}}}
+        data = await http_json_async("POST", url, headers=content_headers(), json_body=body, max_tries=3)
+        if not isinstance(data, dict) or "_http_status" in data:
+            raise RuntimeError(f"content catalog http {data.get('_http_status') if isinstance(data, dict) else '?'}")
+        cards = data.get("cards") if isinstance(data.get("cards"), list) else []
+        ops = _catalog_upsert_ops(cards)
+        nxt = data.get("cursor") if isinstance(data.get("cursor"), dict) else {}
+        if nxt.get("updatedAt") and nxt.get("nmID"):
+            cursor = {"updatedAt": nxt["updatedAt"], "nmID": nxt["nmID"]}
+            ops.append((_KV_SET_SQL, ("catalog_cursor", json.dumps(cursor))))  # page and cursor commit together
+        await store.write(ops)
+        total += len(cards)
+        if not cards or int_safe(nxt.get("total")) < CONTENT_BATCH_SIZE:
+            break
+    _CATALOG_LAST_SYNC_TS = time.time()
+    await store.write([(_KV_SET_SQL, ("catalog_synced_ts", str(_CATALOG_LAST_SYNC_TS)))])
+    return total
 
 
 def _datefrom_for_day(day_msk: datetime) -> str:
     return day_msk.astimezone(MSK).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
 
 
-def stats_orders_for_day(day_msk: datetime) -> List[Dict[str, Any]]:
-    url = f"{WB_STATISTICS_BASE}/api/v1/supplier/orders"
-    params = {"dateFrom": _datefrom_for_day(day_msk), "flag": 1}
-    data = http_json("GET", url, headers=stats_headers(), params=params)
+def _stats_rows_from(data: Any, what: str) -> List[Dict[str, Any]]:
     if isinstance(data, dict) and "_http_status" in data:
-        raise RuntimeError(f"statistics orders http {data.get('_http_status')}: {str(data.get('_text'))[:300]}")
+        raise RuntimeError(f"statistics {what} http {data.get('_http_status')}: {str(data.get('_text'))[:300]}")
     return data if isinstance(data, list) else []
 
 
-def stats_sales_for_day(day_msk: datetime) -> List[Dict[str, Any]]:
+async def stats_orders_for_day_async(day_msk: datetime) -> List[Dict[str, Any]]:
+    url = f"{WB_STATISTICS_BASE}/api/v1/supplier/orders"
+    params = {"dateFrom": _datefrom_for_day(day_msk), "flag": 1}
+    return _stats_rows_from(await http_json_async("GET", url, headers=stats_headers(), params=params), "orders")
+
+
+async def stats_sales_for_day_async(day_msk: datetime) -> List[Dict[str, Any]]:
     url = f"{WB_STATISTICS_BASE}/api/v1/supplier/sales"
     params = {"dateFrom": _datefrom_for_day(day_msk), "flag": 1}
-    data = http_json("GET", url, headers=stats_headers(), params=params)
-    if isinstance(data, dict) and "_http_status" in data:
-        raise RuntimeError(f"statistics sales http {data.get('_http_status')}: {str(data.get('_text'))[:300]}")
-    return data if isinstance(data, list) else []
+    return _stats_rows_from(await http_json_async("GET", url, headers=stats_headers(), params=params), "sales")
 
 
 # ---------------- utils ----------------
@@ -387,12 +1665,39 @@ def fmt_money(v: float) -> str:
     return f"{v:.2f} ₽" if abs(v - round(v)) > 0.001 else f"{int(round(v))} ₽"
 
 
+_FINGERPRINT_ORDER_KEYS = (
+    "createdAt", "dateCreated", "warehouseId", "officeId", "nmId", "chrtId", "article", "skus", "price", "convertedPrice",
+)
+_FINGERPRINT_ITEM_KEYS = ("nmId", "nmID", "chrtId", "chrtID", "skus", "barcode", "price", "quantity")
+
+
+def order_fingerprint(order: Dict[str, Any]) -> str:
+    """Stable across processes and polls: blake2b over a canonical subset of order fields.
+
+    Memoized on the order dict (key "_fingerprint"), so each poll hashes every order once.
+    """
+    fp = order.get("_fingerprint")
+    if isinstance(fp, str):
+        return fp
+    canon: Dict[str, Any] = {k: order.get(k) for k in _FINGERPRINT_ORDER_KEYS if order.get(k) not in (None, "")}
+    items = order.get("items")
+    if isinstance(items, list):
+        canon["items"] = [
+            {k: it.get(k) for k in _FINGERPRINT_ITEM_KEYS if it.get(k) not in (None, "")}
+            for it in items if isinstance(it, dict)
+        ]
+    raw = json.dumps(canon, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    fp = hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+    order["_fingerprint"] = fp
+    return fp
+
+
 def resolve_order_id(order: Dict[str, Any]) -> str:
     for k in ("id", "orderId", "wbOrderId", "rid", "srid"):
         val = order.get(k)
         if val not in (None, ""):
             return str(val)
-    return str(hash(json.dumps(order, ensure_ascii=False, sort_keys=True)))
+    return f"fp:{order_fingerprint(order)}"
 
 
 def order_items(order: Dict[str, Any]) -> List[Dict[str, Any]]:
@@ -416,22 +1721,45 @@ def first_sku(it: Dict[str, Any]) -> str:
     return str(skus or "").strip()
 
 
-def resolve_chrt_id(it: Dict[str, Any]) -> int:
+def item_nm_id(it: Dict[str, Any]) -> int:
+    return int_safe(it.get("nmId") or it.get("nmID"))
+
+
+def _chrt_id_local(it: Dict[str, Any], entry: Optional[CardEntry]) -> Optional[int]:
+    """chrtId from the order item, the barcode index or the item's card; None when only a
+    fresher copy of the card could tell (barcode not in a card older than CARD_REFRESH_MIN_SECONDS)."""
     direct = int_safe(it.get("chrtId") or it.get("chrtID"))
     if direct:
         return direct
-
-    nm_id = int_safe(it.get("nmId") or it.get("nmID"))
+    nm_id = item_nm_id(it)
     barcode = first_sku(it)
     if not nm_id or not barcode:
         return 0
+    chrt_id = _BARCODE_INDEX.get(barcode)
+    if chrt_id:
+        return chrt_id
+    if entry is None or _known_missing("chrt", nm_id, barcode):
+        return 0
+    chrt_id = entry.barcodes.get(barcode, 0)
+    if not chrt_id and time.time() - entry.fetched_ts > CARD_REFRESH_MIN_SECONDS:
+        return None
+    return chrt_id
+
 
-    # fallback: Content sizes contains chrtID/chrtId and skus list
-    for s in content_get_sizes(nm_id):
-        s_skus = s.get("skus") or []
-        if barcode and str(barcode) in [str(x) for x in s_skus]:
-            return int_safe(s.get("chrtId") or s.get("chrtID"))
-    return 0
+async def resolve_chrt_ids_async(items: List[Dict[str, Any]], cards: Dict[int, CardEntry]) -> List[int]:
+    """chrtId per item. Cards that may have gained a size since they were cached are refetched
+    together in one batch; the fresh entries replace the old ones in cards."""
+    chrt_ids = [_chrt_id_local(it, cards.get(item_nm_id(it))) for it in items]
+    stale = list(dict.fromkeys(item_nm_id(it) for it, cid in zip(items, chrt_ids) if cid is None))
+    if stale:
+        cards.update(await content_fetch_cards_async(stale))
+    for i, it in enumerate(items):
+        if chrt_ids[i] is None:
+            entry = cards.get(item_nm_id(it))
+            chrt_ids[i] = entry.barcodes.get(first_sku(it), 0) if entry else 0
+            if not chrt_ids[i]:
+                _remember_missing("chrt", item_nm_id(it), first_sku(it))
+    return [cid or 0 for cid in chrt_ids]
 
 
 def resolve_warehouse_id(order: Dict[str, Any], it: Dict[str, Any]) -> int:
@@ -440,14 +1768,12 @@ def resolve_warehouse_id(order: Dict[str, Any], it: Dict[str, Any]) -> int:
     )
 
 
-def product_name(it: Dict[str, Any]) -> str:
-    nm_id = int_safe(it.get("nmId") or it.get("nmID"))
-
+def item_name(it: Dict[str, Any], entry: Optional[CardEntry]) -> str:
     # IMPORTANT: for /api/v3/orders/new, fields like subject/name in the order payload
     # can be incomplete, category-like, or inconsistent after card edits.
     # To avoid messages like "cash tape" mixed with a comb nmId/vendorCode,
     # we prefer the real card title from Content API by nmId.
-    name = content_title(nm_id)
+    name = entry.title if entry else ""
     if name:
         return name
 
@@ -458,13 +1784,12 @@ def product_name(it: Dict[str, Any]) -> str:
         if val:
             return val
 
-    article = seller_article(it)
+    article = item_article(it, entry)
     return article or "Товар"
 
 
-def seller_article(it: Dict[str, Any]) -> str:
-    nm_id = int_safe(it.get("nmId") or it.get("nmID"))
-    vc = content_vendor_code(nm_id)
+def item_article(it: Dict[str, Any], entry: Optional[CardEntry]) -> str:
+    vc = entry.vendor_code if entry else ""
     if vc:
         return vc
     for k in ("supplierArticle", "vendorCode", "article"):
@@ -490,53 +1815,230 @@ def order_qty(it: Dict[str, Any]) -> int:
 
 
 # ---------------- formatting ----------------
-def fmt_fbs_order(order: Dict[str, Any]) -> str:
-    oid = resolve_order_id(order)
-    created = str(order.get("createdAt") or order.get("dateCreated") or order.get("created") or "").strip()
-    wh_name = str(order.get("warehouseName") or order.get("warehouse") or "").strip()
+@dataclass
+class ItemView:
+    name: str
+    nm_id: int
+    article: str
+    sku: str
+    qty: int
+    line_sum: float
+    stock: Optional[int]
+    warehouse_id: int = 0
+
+
+@dataclass
+class OrderView:
+    """Everything a notification shows for one order; renderers below are pure functions of it."""
+    oid: str
+    created: str
+    wh_name: str
+    items: List[ItemView]
+    total_qty: int
+    total_sum: float
+
+
+def _item_view(it: Dict[str, Any], entry: Optional[CardEntry], warehouse_id: int, stock: Optional[int]) -> ItemView:
+    qty = order_qty(it)
+    price = order_price(it)
+    return ItemView(
+        name=item_name(it, entry),
+        nm_id=int_safe(it.get("nmId") or it.get("nmID")),
+        article=item_article(it, entry),
+        sku=skus_text(it),
+        qty=qty,
+        line_sum=price * qty if price else 0.0,
+        stock=stock,
+        warehouse_id=warehouse_id,
+    )
+
+
+def _order_view(order: Dict[str, Any], items: List[ItemView]) -> OrderView:
+    return OrderView(
+        oid=resolve_order_id(order),
+        created=str(order.get("createdAt") or order.get("dateCreated") or order.get("created") or "").strip(),
+        wh_name=str(order.get("warehouseName") or order.get("warehouse") or "").strip(),
+        items=items,
+        total_qty=sum(i.qty for i in items),
+        total_sum=sum(i.line_sum for i in items),
+    )
 
-    items = order_items(order)
-    total_qty = 0
-    total_sum = 0.0
 
+def render_fbs_order(v: OrderView) -> str:
     lines: List[str] = [f"🏬 Новый заказ FBS · {SHOP_NAME}"]
-    if wh_name:
-        lines.append(f"📦 Склад отгрузки: {wh_name}")
-    if oid:
-        lines.append(f"Заказ: {oid}")
-    if created:
-        lines.append(f"Дата: {created}")
+    if v.wh_name:
+        lines.append(f"📦 Склад отгрузки: {v.wh_name}")
+    if v.oid:
+        lines.append(f"Заказ: {v.oid}")
+    if v.created:
+        lines.append(f"Дата: {v.created}")
     lines.append("")
 
-    for it in items:
-        qty = order_qty(it)
-        price = order_price(it)
-        line_sum = price * qty if price else 0.0
-        total_qty += qty
-        total_sum += line_sum
-
-        nm_id = int_safe(it.get("nmId") or it.get("nmID"))
-        chrt_id = resolve_chrt_id(it)
-        warehouse_id = resolve_warehouse_id(order, it)
-        stock = seller_stock_amount(warehouse_id, chrt_id) if warehouse_id and chrt_id else None
-        stock_text = str(stock) if stock is not None else "-"
-
-        lines.append(f"• {product_name(it)}")
-        if nm_id:
-            lines.append(f"  Артикул WB: {nm_id}")
-        article = seller_article(it)
-        if article:
-            lines.append(f"  Артикул продавца: {article}")
-        sku = skus_text(it)
-        if sku:
-            lines.append(f"  SKU/Баркод: {sku}")
-        lines.append(f"  — {qty} шт" + (f" • {fmt_money(line_sum)}" if line_sum else ""))
-        lines.append(f"  Остаток FBS: {stock_text}")
+    for i in v.items:
+        lines.append(f"• {i.name}")
+        if i.nm_id:
+            lines.append(f"  Артикул WB: {i.nm_id}")
+        if i.article:
+            lines.append(f"  Артикул продавца: {i.article}")
+        if i.sku:
+            lines.append(f"  SKU/Баркод: {i.sku}")
+        lines.append(f"  — {i.qty} шт" + (f" • {fmt_money(i.line_sum)}" if i.line_sum else ""))
+        lines.append(f"  Остаток FBS: {i.stock if i.stock is not None else '-'}")
 
     lines.append("")
-    lines.append(f"Итого позиций: {total_qty}")
-    if total_sum:
-        lines.append(f"Сумма: {fmt_money(total_sum)}")
+    lines.append(f"Итого позиций: {v.total_qty}")
+    if v.total_sum:
+        lines.append(f"Сумма: {fmt_money(v.total_sum)}")
+    return "\n".join(lines)
+
+
+def render_fbs_order_compact(v: OrderView) -> str:
+    """Short per-order block for packed burst messages."""
+    head = f"📦 {v.oid}" + (f" · {v.wh_name}" if v.wh_name else "")
+    if v.total_sum:
+        head += f" · {fmt_money(v.total_sum)}"
+    lines = [head]
+    for i in v.items:
+        stock = i.stock if i.stock is not None else "-"
+        line = f"• {i.name} — {i.qty} шт"
+        if i.article:
+            line += f" · {i.article}"
+        lines.append(line + f" · ост. {stock}")
+    return "\n".join(lines)
+
+
+def tg_len(text: str) -> int:
+    """Length as Telegram counts it (UTF-16 code units)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+TG_MESSAGE_LIMIT = 4096
+
+
+def _hard_split(line: str, budget: int) -> List[str]:
+    """Split one over-long line by code points, counting UTF-16 units per char."""
+    out: List[str] = []
+    start = used = 0
+    for idx, ch in enumerate(line):
+        w = 2 if ord(ch) > 0xFFFF else 1
+        if used + w > budget:
+            out.append(line[start:idx])
+            start, used = idx, 0
+        used += w
+    out.append(line[start:])
+    return out
+
+
+def split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    """Split text into numbered parts of at most limit UTF-16 units.
+
+    Breaks preferably between items (lines starting with "• " / "📦 " or after a blank line),
+    then between lines, and only cuts inside a line that alone is too long. Each line is
+    measured once.
+    """
+    if tg_len(text) <= limit:
+        return [text]
+    budget = limit - 12  # room for the "(nn/nn)\n" part header
+
+    # segments: runs of lines that belong to one item, with their measured size
+    segments: List[Tuple[List[str], int]] = []
+    cur: List[str] = []
+    cur_len = 0
+    for line in text.split("\n"):
+        starts_item = line.startswith(("• ", "📦 ")) or (cur and cur[-1] == "")
+        if cur and starts_item:
+            segments.append((cur, cur_len))
+            cur, cur_len = [], 0
+        cur.append(line)
+        cur_len += tg_len(line) + 1
+
+    if cur:
+        segments.append((cur, cur_len))
+
+    parts: List[str] = []
+    buf: List[str] = []
+    buf_len = 0
+
+    def flush() -> None:
+        nonlocal buf, buf_len
+        if buf:
+            parts.append("\n".join(buf).strip("\n"))
+        buf, buf_len = [], 0
+
+    for lines, seg_len in segments:
+        if buf_len + seg_len <= budget:
+            buf.extend(lines)
+            buf_len += seg_len
+            continue
+        flush()
+        if seg_len <= budget:
+            buf, buf_len = list(lines), seg_len
+            continue
+        for line in lines:  # one item alone is too long: fall back to line breaks
+            n = tg_len(line) + 1
+            if buf_len + n > budget:
+                flush()
+            if n > budget:
+                for chunk in _hard_split(line, budget):
+                    buf, buf_len = [chunk], budget
+                    flush()
+                continue
+            buf.append(line)
+            buf_len += n
+    flush()
+
+    parts = [p for p in parts if p]
+    total = len(parts)
+    return [f"({i}/{total})\n{p}" for i, p in enumerate(parts, 1)] if total > 1 else parts
+
+
+def pack_order_blocks(blocks: List[str], max_orders: int, limit: int = TG_MESSAGE_LIMIT) -> List[List[int]]:
+    """Greedy packing of per-order blocks into messages: indexes of blocks per message,
+    at most max_orders blocks and limit characters (with the header) each."""
+    packs: List[List[int]] = []
+    cur: List[int] = []
+    size = tg_len(fmt_order_pack_header(max_orders)) + 1
+    budget = size
+    for idx, block in enumerate(blocks):
+        need = tg_len(block) + 2  # blank line between blocks
+        if cur and (len(cur) >= max_orders or budget + need > limit):
+            packs.append(cur)
+            cur, budget = [], size
+        cur.append(idx)
+        budget += need
+    if cur:
+        packs.append(cur)
+    return packs
+
+
+def fmt_order_pack_header(n: int) -> str:
+    return f"🏬 Новые заказы FBS · {SHOP_NAME} ({n})"
+
+
+def fmt_order_pack(blocks: List[str]) -> str:
+    return fmt_order_pack_header(len(blocks)) + "\n\n" + "\n\n".join(blocks)
+
+
+def fmt_bootstrap_digest(orders: List[Dict[str, Any]], limit: int = 30) -> str:
+    """Compact one-message summary of orders marked seen on bootstrap. Uses order payload only (no API calls)."""
+    lines: List[str] = [
+        f"🔄 Перезапуск · {SHOP_NAME}",
+        f"FBS-заказов в ожидании сборки: {len(orders)} (отмечены как известные, без отдельных уведомлений)",
+        "",
+    ]
+    for o in orders[:limit]:
+        items = order_items(o)
+        qty = sum(order_qty(it) for it in items)
+        total = sum(order_price(it) * order_qty(it) for it in items)
+        created = str(o.get("createdAt") or o.get("dateCreated") or "").strip()
+        line = f"• {resolve_order_id(o)} — {qty} шт"
+        if total:
+            line += f" • {fmt_money(total)}"
+        if created:
+            line += f" · {created}"
+        lines.append(line)
+    if len(orders) > limit:
+        lines.append(f"… и ещё {len(orders) - limit}")
     return "\n".join(lines)
 
 
@@ -584,25 +2086,408 @@ def fmt_daily_report(day_msk: datetime, orders: List[Dict[str, Any]], sales: Lis
     )
 
 
+# ---------------- chat routing ----------------
+@dataclass
+class Route:
+    chat_id: str
+    warehouses: Optional[FrozenSet[int]] = None
+    articles: FrozenSet[str] = frozenset()       # exact vendor codes (casefolded)
+    article_prefixes: Tuple[str, ...] = ()       # "PREFIX*" vendor codes (casefolded)
+    min_sum: float = 0.0
+
+    def matches(self, v: OrderView) -> bool:
+        if self.min_sum and v.total_sum < self.min_sum:
+            return False
+        if self.articles or self.article_prefixes:
+            arts = [i.article.casefold() for i in v.items if i.article]
+            if not any(a in self.articles or a.startswith(self.article_prefixes) for a in arts):
+                return False
+        return True
+
+
+class RoutingTable:
+    """TG_ROUTES compiled once: warehouse-bound routes are indexed by warehouse id, the rest are
+    checked for every order, so a lookup only touches routes that can possibly match."""
+
+    def __init__(self, routes: List[Route], default_chat: str, default_mode: str, invalid: Iterable[str] = ()) -> None:
+        self.invalid = list(invalid)  # specs that didn't parse, reported at startup
+        self.default_chat = default_chat
+        self.default_mode = default_mode
+        self.by_warehouse: Dict[int, List[Route]] = {}
+        self.any_warehouse: List[Route] = []
+        for r in routes:
+            if r.warehouses is None:
+                self.any_warehouse.append(r)
+            for wid in r.warehouses or ():
+                self.by_warehouse.setdefault(wid, []).append(r)
+
+    def chats_for(self, v: OrderView) -> List[str]:
+        chats: List[str] = []
+        candidates = list(self.any_warehouse)
+        for wid in {i.warehouse_id for i in v.items}:
+            candidates.extend(self.by_warehouse.get(wid, ()))
+        for r in candidates:
+            if r.chat_id not in chats and r.matches(v):
+                chats.append(r.chat_id)
+        if self.default_chat and (self.default_mode != "unmatched" or not chats):
+            if self.default_chat in chats:
+                chats.remove(self.default_chat)
+            chats.insert(0, self.default_chat)
+        return chats
+
+
+def _parse_route(spec: str) -> Optional[Route]:
+    chat, _, conds = spec.strip().partition(":")
+    if not chat.strip():
+        return None
+    route = Route(chat_id=chat.strip())
+    for cond in conds.split(","):
+        cond = cond.strip()
+        if not cond:
+            continue
+        if cond.startswith("sum>="):
+            try:
+                route.min_sum = float(cond[5:])
+            except ValueError:
+                return None
+            continue
+        key, _, raw = cond.partition("=")
+        values = [x.strip() for x in raw.split("|") if x.strip()]
+        if key.strip() == "wh":
+            warehouses = [int_safe(x) for x in values]
+            if not warehouses or not all(warehouses):
+                return None  # an empty or unparsable list would never match
+            route.warehouses = frozenset(warehouses)
+        elif key.strip() == "article":
+            if not values:
+                return None
+            route.articles = frozenset(x.casefold() for x in values if not x.endswith("*"))
+            route.article_prefixes = tuple(x[:-1].casefold() for x in values if x.endswith("*"))
+        else:
+            return None
+    return route
+
+
+def compile_routes(raw: str) -> RoutingTable:
+    routes: List[Route] = []
+    invalid: List[str] = []
+    for spec in raw.split(";"):
+        if not spec.strip():
+            continue
+        route = _parse_route(spec)
+        if route:
+            routes.append(route)
+        else:
+            invalid.append(spec.strip())
+    return RoutingTable(routes, TG_CHAT_ID, TG_ROUTE_DEFAULT, invalid)
+
+
+ROUTES = compile_routes(TG_ROUTES)
+
+
+# ---------------- enrichment ----------------
+async def gather_bounded(aws: List[Any], limit: int = FBS_ENRICH_CONCURRENCY) -> List[Any]:
+    """asyncio.gather with at most `limit` awaitables running; exceptions are returned, not raised."""
+    slots = asyncio.Semaphore(max(1, limit))
+
+    async def run(aw: Any) -> Any:
+        async with slots:
+            return await aw
+
+    return await asyncio.gather(*(run(aw) for aw in aws), return_exceptions=True)
+
+
+async def fbs_order_views_async(orders: List[Dict[str, Any]]) -> List[Any]:
+    """Views for a batch of orders in three batched phases: cards (cards/list per 100 uncached
+    nmIds), chrtIds (one refetch for cards missing a barcode), then one stocks request per
+    warehouse. Rendering the views needs no further I/O.
+    A failed order yields its exception instead of a view."""
+    lines = [(o, it) for o in orders for it in order_items(o)]
+    cards = await content_cards_async(item_nm_id(it) for _, it in lines)
+    chrt_ids = await resolve_chrt_ids_async([it for _, it in lines], cards)
+
+    by_wh: Dict[int, List[int]] = {}
+    for (o, it), chrt_id in zip(lines, chrt_ids):
+        warehouse_id = resolve_warehouse_id(o, it)
+        if warehouse_id and chrt_id:
+            by_wh.setdefault(warehouse_id, []).append(chrt_id)
+    stocks: Dict[int, Dict[int, int]] = {}
+    for warehouse_id, res in zip(by_wh, await gather_bounded([seller_stock_amounts_async(wh, c) for wh, c in by_wh.items()])):
+        if isinstance(res, dict):
+            stocks[warehouse_id] = res
+
+    views: List[Any] = []
+    pos = 0
+    for o in orders:
+        n = len(order_items(o))
+        try:
+            items = []
+            for (_, it), chrt_id in zip(lines[pos:pos + n], chrt_ids[pos:pos + n]):
+                warehouse_id = resolve_warehouse_id(o, it)
+                stock = stocks.get(warehouse_id, {}).get(chrt_id) if warehouse_id and chrt_id else None
+                items.append(_item_view(it, cards.get(item_nm_id(it)), warehouse_id, stock))
+            views.append(_order_view(o, items))
+        except Exception as e:
+            views.append(e)
+        pos += n
+    return views
+
+
 # ---------------- loops ----------------
-async def poll_fbs_loop(conn: sqlite3.Connection) -> None:
+async def needs_bootstrap(store: Storage) -> bool:
+    if FBS_BOOTSTRAP_MODE not in ("digest", "silent"):
+        return False
+    latest = await store.call(latest_seen_at)
+    if not latest:
+        return True
+    try:
+        age = datetime.now(tz=MSK) - datetime.fromisoformat(latest)
+    except ValueError:
+        return False
+    return age > timedelta(hours=FBS_BOOTSTRAP_STALE_HOURS)
+
+
+async def bootstrap_seen(store: Storage, outbox: TelegramOutbox, orders: List[Dict[str, Any]]) -> None:
+    """Mark every order currently in /orders/new as seen in one transaction; no per-order enrichment."""
+    writes = WriteBatch(store)
+    for o in orders:
+        writes.mark_seen(resolve_order_id(o))
+    await writes.flush()
+    if orders and FBS_BOOTSTRAP_MODE == "digest":
+        await outbox.enqueue(fmt_bootstrap_digest(orders))
+
+
+@dataclass
+class StageStats:
+    items: int = 0
+    busy_seconds: float = 0.0
+    max_seconds: float = 0.0
+    errors: int = 0
+    dropped: int = 0
+
+    def record(self, started: float, n: int = 1) -> None:
+        took = time.monotonic() - started
+        self.items += n
+        self.busy_seconds += took
+        self.max_seconds = max(self.max_seconds, took)
+
+
+class FbsPipeline:
+    """New FBS orders flow through poll -> dedupe -> enrich -> render -> store stages.
+
+    Stages are joined by bounded queues, so a slow stage backs up its own queue instead of the
+    whole loop. Polling never waits on them: when the dedupe queue is full the polled batch is
+    dropped (the orders are still in /orders/new next time). Orders are tracked from dedupe
+    until their seen-mark is committed, so a re-poll can't notify them twice. "store" commits
+    outbox rows and seen-marks; DurableOutbox does the actual Telegram delivery.
+    """
+
+    def __init__(self, store: Storage, outbox: TelegramOutbox, durable: DurableOutbox) -> None:
+        self.store = store
+        self.outbox = outbox
+        self.durable = durable
+        self.dedupe_q: "asyncio.Queue[List[Dict[str, Any]]]" = asyncio.Queue(FBS_PIPELINE_BATCHES)
+        self.enrich_q: "asyncio.Queue[List[Tuple[str, Dict[str, Any]]]]" = asyncio.Queue(FBS_PIPELINE_BATCHES)
+        self.render_q: "asyncio.Queue[Tuple[str, OrderView]]" = asyncio.Queue(FBS_PIPELINE_ORDERS)
+        self.store_q: "asyncio.Queue[Tuple[str, List[Tuple[str, str, str]]]]" = asyncio.Queue(FBS_PIPELINE_ORDERS)
+        self.inflight: set = set()  # order ids between dedupe and a committed seen-mark
+        self.stages: Dict[str, StageStats] = {n: StageStats() for n in ("poll", "dedupe", "enrich", "render", "store")}
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        depth = {"dedupe": self.dedupe_q, "enrich": self.enrich_q, "render": self.render_q, "store": self.store_q}
+        out: Dict[str, Dict[str, Any]] = {}
+        for name, st in self.stages.items():
+            out[name] = dict(
+                vars(st),
+                busy_seconds=round(st.busy_seconds, 3),
+                max_seconds=round(st.max_seconds, 3),
+                queued=depth[name].qsize() if name in depth else 0,
+            )
+        out["inflight"] = {"orders": len(self.inflight)}
+        return out
+
+    async def run(self) -> None:
+        await asyncio.gather(self._poll(), self._dedupe(), self._enrich(), self._render(), self._store())
+
+    async def _warn(self, stage: str, e: Exception) -> None:
+        self.stages[stage].errors += 1
+        await self.outbox.enqueue(f"⚠️ FBS {stage} error: {e}")
+
+    async def _poll(self) -> None:
+        bootstrap: Optional[bool] = None  # decided on the first poll that gets that far
+        while True:
+            due = time.monotonic() + POLL_FBS_SECONDS + random.random() * 2.0
+            started = time.monotonic()
+            try:
+                if bootstrap is None:
+                    bootstrap = await needs_bootstrap(self.store)
+                orders = await mp_get_new_fbs_orders_async()
+                if bootstrap:
+                    await bootstrap_seen(self.store, self.outbox, orders)
+                    bootstrap = False
+                elif orders:
+                    try:
+                        self.dedupe_q.put_nowait(orders)
+                    except asyncio.QueueFull:
+                        self.stages["poll"].dropped += 1
+                self.stages["poll"].record(started, len(orders))
+            except Exception as e:
+                await self._warn("poll", e)
+            await asyncio.sleep(max(0.0, due - time.monotonic()))
+
+    async def _dedupe(self) -> None:
+        while True:
+            orders = await self.dedupe_q.get()
+            started = time.monotonic()
+            try:
+                keyed = [(resolve_order_id(o), o) for o in orders]
+                keyed = [k for k in keyed if k[0] not in self.inflight]
+                unseen = await _SEEN.unseen(self.store, [oid for oid, _ in keyed])
+                fresh = [(oid, o) for oid, o in keyed if oid in unseen]
+                self.stages["dedupe"].record(started, len(fresh))
+                if fresh:
+                    self.inflight.update(oid for oid, _ in fresh)
+                    await self.enrich_q.put(fresh)
+            except Exception as e:
+                await self._warn("dedupe", e)
+
+    async def _enrich(self) -> None:
+        while True:
+            fresh = await self.enrich_q.get()
+            started = time.monotonic()
+            batch = [o for _, o in fresh]
+            try:
+                views = await fbs_order_views_async(batch)
+            except Exception as e:
+                self.inflight.difference_update(oid for oid, _ in fresh)
+                await self._warn("enrich", e)
+                continue
+            self.stages["enrich"].record(started, len(fresh))
+            failed: Optional[BaseException] = None
+            for (oid, _), view in zip(fresh, views):
+                if isinstance(view, OrderView):
+                    await self.render_q.put((oid, view))
+                else:
+                    self.inflight.discard(oid)  # retried on the next poll
+                    failed = view
+            if failed is not None:
+                await self._warn("enrich", failed)  # type: ignore[arg-type]
+
+    async def _render(self) -> None:
+        while True:
+            oid, view = await self.render_q.get()
+            started = time.monotonic()
+            try:
+                if FBS_COALESCE:
+                    text, kind = render_fbs_order_compact(view), "order_block"
+                else:
+                    text, kind = render_fbs_order(view), "text"
+                messages = [(chat_id, text, kind) for chat_id in ROUTES.chats_for(view)]
+            except Exception as e:
+                self.inflight.discard(oid)
+                await self._warn("render", e)
+                continue
+            self.stages["render"].record(started)
+            await self.store_q.put((oid, messages))
+
+    async def _store(self) -> None:
+        while True:
+            item = await self.store_q.get()
+            started = time.monotonic()
+            writes = WriteBatch(self.store)
+            oids: List[str] = []
+            try:
+                # group-commit whatever has piled up behind the first order
+                while True:
+                    oid, messages = item
+                    for chat_id, text, kind in messages:
+                        writes.queue_message(text, chat_id=chat_id, kind=kind)
+                    writes.mark_seen(oid)
+                    oids.append(oid)
+                    if self.store_q.empty() or len(oids) >= STORAGE_GROUP_MAX:
+                        break
+                    item = self.store_q.get_nowait()
+                await writes.flush()
+                self.stages["store"].record(started, len(oids))
+            except Exception as e:
+                await self._warn("store", e)
+            finally:
+                self.inflight.difference_update(oids)
+                self.durable.wake.set()
+
+
+async def poll_fbs_loop(pipeline: FbsPipeline) -> None:
     if not WB_MP_TOKEN:
-        await asyncio.to_thread(tg_send, "⚠️ WB_MP_TOKEN не задан — уведомления по FBS-заказам отключены.")
+        await pipeline.outbox.enqueue("⚠️ WB_MP_TOKEN не задан — уведомления по FBS-заказам отключены.")
+        return
+
+    await pipeline.run()
+
+
+def worker_stats(store: Storage, outbox: TelegramOutbox, pipeline: FbsPipeline) -> Dict[str, Any]:
+    return {
+        "pipeline": pipeline.stats(),
+        "seen": _SEEN.stats(),
+        "storage": store.stats(),
+        "outbox": outbox.outbox_stats(),
+        "caches": cache_stats(),
+        "singleflight": singleflight_stats(),
+        "rate_limits": rate_limiter_stats(),
+        "http": http_session_stats(),
+    }
+
+
+async def stats_log_loop(store: Storage, outbox: TelegramOutbox, pipeline: FbsPipeline) -> None:
+    if STATS_LOG_SECONDS <= 0:
         return
 
     while True:
+        await asyncio.sleep(STATS_LOG_SECONDS)
         try:
-            orders = await asyncio.to_thread(mp_get_new_fbs_orders)
-            for o in orders:
-                oid = resolve_order_id(o)
-                if seen_order(conn, oid):
-                    continue
-                await asyncio.to_thread(tg_send, fmt_fbs_order(o))
-                mark_seen(conn, oid)
-        except Exception as e:
-            await asyncio.to_thread(tg_send, f"⚠️ FBS polling error: {e}")
+            line = json.dumps(worker_stats(store, outbox, pipeline), ensure_ascii=False, default=str)
+            print(f"stats {line}", flush=True)
+        except Exception:
+            pass
+
 
-        await asyncio.sleep(POLL_FBS_SECONDS + random.random() * 2.0)
+async def seen_prune_loop(store: Storage) -> None:
+    if SEEN_RETENTION_DAYS <= 0:
+        return
+
+    while True:
+        try:
+            cutoff = (datetime.now(tz=MSK) - timedelta(days=SEEN_RETENTION_DAYS)).isoformat()
+            removed = 0
+            while True:
+                n = await store.call(prune_seen_batch, cutoff, SEEN_PRUNE_BATCH)
+                removed += n
+                if n < SEEN_PRUNE_BATCH:
+                    break
+                await asyncio.sleep(0.05)  # small batches: don't hold the write lock or the loop
+            _SEEN.prune(cutoff)
+            while True:
+                n = await store.call(prune_outbox_batch, cutoff, SEEN_PRUNE_BATCH)
+                removed += n
+                if n < SEEN_PRUNE_BATCH:
+                    break
+                await asyncio.sleep(0.05)
+            if removed:
+                await store.call(incremental_vacuum)
+        except Exception:
+            pass
+        await asyncio.sleep(SEEN_PRUNE_SECONDS)
+
+
+async def catalog_sync_loop(store: Storage) -> None:
+    if CATALOG_SYNC_SECONDS <= 0 or not (WB_CONTENT_TOKEN or WB_MP_TOKEN):
+        return
+
+    while True:
+        try:
+            await catalog_sync(store)
+        except Exception:
+            pass  # best-effort: content lookups fall back to cards/list by nmId
+        await asyncio.sleep(CATALOG_SYNC_SECONDS + random.random() * 30.0)
 
 
 def _next_summary_dt(now_msk: datetime) -> datetime:
@@ -617,9 +2502,9 @@ def _next_summary_dt(now_msk: datetime) -> datetime:
     return target
 
 
-async def daily_summary_loop(conn: sqlite3.Connection) -> None:
+async def daily_summary_loop(store: Storage, outbox: TelegramOutbox) -> None:
     if not WB_STATS_TOKEN:
-        await asyncio.to_thread(tg_send, "⚠️ WB_STATS_TOKEN не задан — суточный отчёт отключён.")
+        await outbox.enqueue("⚠️ WB_STATS_TOKEN не задан — суточный отчёт отключён.")
         return
 
     while True:
@@ -629,32 +2514,47 @@ async def daily_summary_loop(conn: sqlite3.Connection) -> None:
 
         day = datetime.now(tz=MSK)
         day_key = day.strftime("%Y-%m-%d")
-        if kv_get(conn, "daily_sent", "") == day_key:
+        if await store.call(kv_get, "daily_sent", "") == day_key:
             continue
 
         try:
-            orders = await asyncio.to_thread(stats_orders_for_day, day)
-            sales = await asyncio.to_thread(stats_sales_for_day, day)
-            await asyncio.to_thread(tg_send, fmt_daily_report(day, orders, sales))
-            kv_set(conn, "daily_sent", day_key)
+            orders = await stats_orders_for_day_async(day)
+            sales = await stats_sales_for_day_async(day)
+            if await outbox.send(fmt_daily_report(day, orders, sales)):
+                batch = WriteBatch(store)
+                batch.kv_set("daily_sent", day_key)
+                await batch.flush()
         except Exception as e:
-            await asyncio.to_thread(tg_send, f"⚠️ Daily report error: {e}")
+            await outbox.enqueue(f"⚠️ Daily report error: {e}")
 
 
 # ---------------- worker entrypoint ----------------
 async def run_worker() -> None:
-    conn = await asyncio.to_thread(db)
+    store = Storage()
+    await store.start()
+    await _SEEN.load(store)
+    await catalog_open(store)
+    outbox = TelegramOutbox()
+    durable = DurableOutbox(store, outbox)
+    asyncio.create_task(durable.run())
 
     if not DISABLE_STARTUP_HELLO:
-        asyncio.create_task(asyncio.to_thread(
-            tg_send,
-            f"✅ WB→Telegram запущен (только FBS-заказы + итоги по магазину). {SHOP_NAME}",
-        ))
+        await outbox.enqueue(f"✅ WB→Telegram запущен (только FBS-заказы + итоги по магазину). {SHOP_NAME}")
+    if ROUTES.invalid:
+        await outbox.enqueue("⚠️ TG_ROUTES: маршруты с ошибкой пропущены — " + "; ".join(ROUTES.invalid))
 
-    asyncio.create_task(poll_fbs_loop(conn))
-    asyncio.create_task(daily_summary_loop(conn))
+    pipeline = FbsPipeline(store, outbox, durable)
+    asyncio.create_task(poll_fbs_loop(pipeline))
+    asyncio.create_task(stats_log_loop(store, outbox, pipeline))
+    asyncio.create_task(daily_summary_loop(store, outbox))
+    asyncio.create_task(catalog_sync_loop(store))
+    asyncio.create_task(seen_prune_loop(store))
 
-    await asyncio.Event().wait()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        store.stop()
+        close_http_sessions()
 
 
 if __name__ == "__main__":